@@ -0,0 +1,227 @@
+import os
+import json
+import gzip
+import zlib
+import hashlib
+import datetime
+import threading
+import logging
+from safe_files import file_lock, replacing
+
+#Query parameters that must never be written to the archive.
+SECRET_PARAMS = ['key']
+#Next to each <YYYYMMDD>.jsonl.gz, the key and byte offset of every record in it.
+KEYS_SUFFIX = '.keys.jsonl'
+
+
+class ResponseArchive:
+    """
+    Append-only archive of every raw upstream response, so new fields can be derived from what we already paid for.
+    Records are gzipped json lines in "directory"/<endpoint>/<YYYYMMDD>.jsonl.gz, one gzip member per record,
+    each holding the endpoint, query, query key, fetched-at time and the full response.
+    Each day file has a <YYYYMMDD>.keys.jsonl sidecar with every record's key and offset, from which latest() and
+    replay(latest_only=True) keep a key -> (file, offset) index, so they only decompress the records they return.
+    Appends to a day file hold a lock on it, shared with other processes, so every offset in its sidecar is right.
+    """
+    def __init__(self, directory = 'response_archive'):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.endpoint_to_index = {} #endpoint -> {'keys': {key: (path, offset)}, 'read': {sidecar path: bytes read}}
+
+    @staticmethod
+    def query_key(endpoint, query):
+        """
+        Returns a stable key for "query" on "endpoint", independent of parameter order.
+        """
+        canonical = json.dumps({'endpoint': endpoint, 'query': query}, sort_keys=True, default=str)
+        return hashlib.sha1(canonical.encode()).hexdigest()
+
+    def append(self, endpoint, query, response_json):
+        """
+        Archives "response_json" as the response of "endpoint" to "query".
+        """
+        query = {k: v for k, v in (query or {}).items() if k not in SECRET_PARAMS}
+        fetched_at = datetime.datetime.now(datetime.timezone.utc)
+        record = {
+            'endpoint': endpoint,
+            'key': self.query_key(endpoint, query),
+            'query': query,
+            'fetchedAt': fetched_at.isoformat(),
+            'response': response_json,
+        }
+        endpoint_dir = os.path.join(self.directory, endpoint)
+        path = os.path.join(endpoint_dir, f'{fetched_at.strftime("%Y%m%d")}.jsonl.gz')
+        member = gzip.compress((json.dumps(record, default=str) + '\n').encode())
+        os.makedirs(endpoint_dir, exist_ok=True)
+        with file_lock(self._lock_file(path)):
+            if not os.path.exists(self._sidecar(path)):
+                self._write_sidecar(path)
+            with open(path, 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                f.write(member)
+            with open(self._sidecar(path), 'a') as f:
+                f.write(json.dumps({'key': record['key'], 'offset': offset}) + '\n')
+
+    @staticmethod
+    def _sidecar(path):
+        return path[:-len('.jsonl.gz')] + KEYS_SUFFIX
+
+    @staticmethod
+    def _lock_file(path):
+        return path[:-len('.jsonl.gz')] + '.lock'
+
+    def _write_sidecar(self, path):
+        """
+        Writes the key sidecar of the day file "path" from its records, for files archived before sidecars were kept.
+        Called with the day file's lock held.
+        """
+        lines = []
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            offset = 0
+            while offset < len(data):
+                decompressor = zlib.decompressobj(wbits=31)
+                record = json.loads(decompressor.decompress(data[offset:]))
+                lines.append(json.dumps({'key': record['key'], 'offset': offset}) + '\n')
+                offset = len(data) - len(decompressor.unused_data)
+        with replacing(self._sidecar(path)) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                f.write(''.join(lines))
+
+    def _day_files(self, endpoint, since = None):
+        """
+        Returns the path of every day file of "endpoint", oldest first, optionally only those on or after the date "since".
+        """
+        endpoint_dir = os.path.join(self.directory, endpoint)
+        if not os.path.isdir(endpoint_dir):
+            return []
+        since_day = since.strftime("%Y%m%d") if since is not None else None
+        return [os.path.join(endpoint_dir, filename) for filename in sorted(os.listdir(endpoint_dir))
+                if filename.endswith('.jsonl.gz') and (since_day is None or filename[:8] >= since_day)]
+
+    def _latest_locations(self, endpoint):
+        """
+        Returns the key -> (path, offset) of the newest record of every query on "endpoint", reading only the sidecar
+        lines added since the last call (by this or any other process).
+        """
+        with self.lock:
+            index = self.endpoint_to_index.setdefault(endpoint, {'keys': {}, 'read': {}})
+            for path in self._day_files(endpoint):
+                sidecar = self._sidecar(path)
+                if not os.path.exists(sidecar):
+                    with file_lock(self._lock_file(path)):
+                        if not os.path.exists(sidecar):
+                            self._write_sidecar(path)
+                read = index['read'].get(sidecar, 0)
+                if os.path.getsize(sidecar) <= read:
+                    continue
+                with open(sidecar, 'rb') as f:
+                    f.seek(read)
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            break #still being written
+                        read += len(line)
+                        entry = json.loads(line)
+                        index['keys'][entry['key']] = (path, entry['offset'])
+                index['read'][sidecar] = read
+            return dict(index['keys'])
+
+    @staticmethod
+    def _read_record(path, offset):
+        """
+        Decompresses only the record starting at byte "offset" of the day file "path".
+        """
+        decompressor = zlib.decompressobj(wbits=31)
+        data = b''
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while not decompressor.eof:
+                chunk = f.read(64 * 1024)
+                if not chunk:
+                    break
+                data += decompressor.decompress(chunk)
+        return json.loads(data)
+
+    def _indexed_record(self, key, path, offset):
+        """
+        Returns the record at byte "offset" of "path" if it is the one for "key", or None if the index is off there.
+        """
+        try:
+            record = self._read_record(path, offset)
+        except (zlib.error, ValueError):
+            return None
+        return record if isinstance(record, dict) and record.get('key') == key else None
+
+    def _latest_records(self, endpoint, since = None):
+        """
+        Yields the newest record of every query on "endpoint", in file order, optionally only those fetched on or after
+        the date "since". Only those records are decompressed, unless the index turns out to be off, then the rest
+        are found by reading every record.
+        """
+        day_files = set(self._day_files(endpoint, since))
+        locations = sorted((location, key) for key, location in self._latest_locations(endpoint).items() if location[0] in day_files)
+        for position, ((path, offset), key) in enumerate(locations):
+            record = self._indexed_record(key, path, offset)
+            if record is None:
+                logging.warning(f"archive index of {path} is off at {offset}, scanning {endpoint}")
+                remaining = {key for _, key in locations[position:]}
+                key_to_record = {}
+                for record in self.records(endpoint, since):
+                    if record['key'] in remaining:
+                        key_to_record[record['key']] = record
+                yield from key_to_record.values()
+                return
+            yield record
+
+    def endpoints(self):
+        """
+        Returns every endpoint with archived responses.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, name)))
+
+    def records(self, endpoint, since = None):
+        """
+        Yields every archived record of "endpoint", oldest first, optionally only those fetched on or after the date "since".
+        """
+        for path in self._day_files(endpoint, since):
+            with gzip.open(path, 'rt') as f:
+                for line in f:
+                    yield json.loads(line)
+
+    def latest(self, endpoint, query):
+        """
+        Returns the most recently archived record for "query" on "endpoint", or None if we never fetched it.
+        """
+        key = self.query_key(endpoint, {k: v for k, v in (query or {}).items() if k not in SECRET_PARAMS})
+        location = self._latest_locations(endpoint).get(key)
+        if location is None:
+            return None
+        record = self._indexed_record(key, *location)
+        if record is None:
+            logging.warning(f"archive index of {location[0]} is off at {location[1]}, scanning {endpoint}")
+            found = None
+            for record in self.records(endpoint):
+                if record['key'] == key:
+                    found = record
+            return found
+        return record
+
+    def replay(self, endpoint, processor, latest_only = True, since = None):
+        """
+        Re-runs "processor"(response_json, query) over the archived responses of "endpoint" without calling the upstream,
+        returning a list of (record, result). With "latest_only", only the newest response to each query is processed.
+        Records the processor fails on are logged and skipped.
+        """
+        records = self._latest_records(endpoint, since) if latest_only else self.records(endpoint, since)
+
+        results = []
+        for record in records:
+            try:
+                results.append((record, processor(record['response'], record['query'])))
+            except (KeyError, TypeError, ValueError) as e:
+                logging.debug(f"replay of {endpoint} {record['query']} failed: {e}")
+        return results
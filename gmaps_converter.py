@@ -1,11 +1,30 @@
-from flask import Flask, jsonify, render_template, request
-import numpy as np
+from flask import Blueprint, Flask, current_app, jsonify, render_template, request
 import json
+import gzip
+import hmac
+import math
+import os
+import datetime
+import threading
 from collections import namedtuple
-import requests
-import pandas as pd
 from keal_estate import KealEstate
+from marker_index import MarkerIndex
+from handlers import ZillowAPIManager, load_api_keys, RENTAL_DIRECTORY, TAX_DIRECTORY
+from listing_store import ListingStore, LISTINGS_DIRECTORY
+from quota import FetchPlanner, QuotaExceeded, UsageCounter, GEOCODE, ZIPCODE
 import logging
+from archive import ResponseArchive
+from upstream import UpstreamUnavailable, controller_states, get_controller
+from jobs import JobManager, JobQueueFull
+from snapshot_store import CashflowSnapshotStore
+from safe_files import file_lock, write_json
+#numpy, pandas, pyarrow and requests are slow to import, so every module imports them inside the functions that use them
+#(test/test_import_time.py keeps it that way).
+
+try:
+    import brotli
+except ImportError:
+    brotli = None #optional, responses fall back to gzip without it
 
 
 class ZipAPIFailed(Exception):
@@ -16,29 +35,201 @@ class GeocodeAPIFailed(Exception):
     """Raised when the Google Geocoding API fails."""
     pass
 
-app = Flask(__name__)
+#Defaults for create_app(), any of them can be overridden by the config passed in.
+DEFAULT_CONFIG = {
+    'API_KEYS_FILE': 'api_keys.json',
+    'API_KEYS': None, #read from API_KEYS_FILE when not given
+    'MARKER_INDEX_FILE': 'marker_index.json',
+    'GEOCODES_FILE': 'geocodes.json',
+    'LOG_LEVEL': logging.CRITICAL,
+    #Upstream call budgets, None turns a budget off.
+    'USAGE_FILE': 'api_usage.json',
+    'QUOTA_PER_REQUEST': 300,
+    'QUOTA_PER_USER_DAY': 1000,
+    'QUOTA_PER_DAY': {'zillow': 2000, 'geocode': 5000, 'zipcode': 100},
+    'OPS_TOKEN': None, #bearer token for /ops, without one /ops only answers requests from this machine
+    'ARCHIVE_DIR': 'response_archive', #raw upstream responses
+    'LISTING_COMPACTION_SECONDS': 3600, #how often the listing delta log is compacted, None to leave it to cron
+    #Background marker searches (/jobs). Jobs only exist in the process that runs them, so /jobs needs a single
+    #HTTP worker process (use threads to scale it) or sticky sessions routing a client to the same process.
+    'JOB_WORKERS': 2, #searches running at once, independent of the HTTP workers
+    'JOB_QUEUE_LIMIT': 20, #searches waiting for a worker before new ones are refused
+    'JOB_RESULT_SECONDS': 3600, #how long finished searches are kept and reused by identical ones
+    'SNAPSHOT_DIR': 'cashflow_data/snapshots', #every scored listing, by day and zip, for /history queries
+    'LISTING_DIR': LISTINGS_DIRECTORY, #the listing store's snapshot, delta log and price history
+    'TAX_DIR': TAX_DIRECTORY, #fetched tax data, one file per listing
+    'RENTAL_DIR': RENTAL_DIRECTORY, #fetched rental data, one file per listing
+    'NEAR_ZIPS_FILE': 'near_zips.json', #cached zipcodes near each searched zip
+    'NEAR_ZIP_DISTANCES_FILE': 'near_zip_distances.json',
+}
+
+bp = Blueprint('gmaps', __name__)
+
+def create_app(config = None):
+    """
+    Builds the Flask app with "config" layered over DEFAULT_CONFIG. Everything with side effects
+    (reading keys, loading the marker index, configuring logging) happens here rather than on import.
+    """
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.update(config or {})
+    if app.config['API_KEYS'] is None:
+        app.config['API_KEYS'] = load_api_keys(app.config['API_KEYS_FILE'])
+
+    logging.basicConfig(level=app.config['LOG_LEVEL'])
+    usage_counter = UsageCounter(app.config['USAGE_FILE'], app.config['QUOTA_PER_REQUEST'], app.config['QUOTA_PER_USER_DAY'], app.config['QUOTA_PER_DAY'])
+    app.extensions['usage_counter'] = usage_counter
+    archive = ResponseArchive(app.config['ARCHIVE_DIR'])
+    app.extensions['archive'] = archive
+    app.extensions['snapshot_store'] = CashflowSnapshotStore(app.config['SNAPSHOT_DIR'])
+    app.extensions['zillow'] = ZillowAPIManager(app.config['API_KEYS'], usage_counter, archive)
+    #Every marker we have scored and geocoded, for answering viewport queries without the pipeline.
+    app.extensions['marker_index'] = MarkerIndex.load(app.config['MARKER_INDEX_FILE'])
+    #Shared by every request and job, so a geocode bought by one is never bought again by another.
+    app.extensions['geocodes'] = GeocodeCache(app.config['GEOCODES_FILE'])
+    app.extensions['jobs'] = JobManager(app.config['JOB_WORKERS'], app.config['JOB_QUEUE_LIMIT'], app.config['JOB_RESULT_SECONDS'])
+
+    if app.config['LISTING_COMPACTION_SECONDS'] is not None:
+        ListingStore.start_compaction(app.config['LISTING_COMPACTION_SECONDS'], app.config['LISTING_DIR'])
+
+    app.register_blueprint(bp)
+    return app
+
+def _marker_index():
+    return current_app.extensions['marker_index']
+
+def _usage_counter():
+    return current_app.extensions['usage_counter']
+
+def _user():
+    """
+    Who upstream calls of the current request are charged to: the client address, which (unlike a header) it can't pick.
+    """
+    return request.remote_addr
+
+def _ops_authorized():
+    """
+    Whether the current request may read /ops: it carries the configured OPS_TOKEN, or there is none and it comes from this machine.
+    """
+    token = current_app.config['OPS_TOKEN']
+    if token is None:
+        return request.remote_addr in ('127.0.0.1', '::1')
+    return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+
+def _gmaps_interlinker():
+    return GmapsInterlinker(current_app.config['API_KEYS'], _marker_index(), _usage_counter(), current_app.extensions['archive'], current_app.extensions['geocodes'],
+                            current_app.config['NEAR_ZIPS_FILE'], current_app.config['NEAR_ZIP_DISTANCES_FILE'])
+
+def _keal_estate(excluded_home_types):
+    config = current_app.config
+    return KealEstate(excluded_home_types, _snapshot_store(), ListingStore(config['LISTING_DIR']), current_app.extensions['zillow'], config['TAX_DIR'], config['RENTAL_DIR'])
+
+def _jobs():
+    return current_app.extensions['jobs']
+
+def _snapshot_store():
+    return current_app.extensions['snapshot_store']
 
-with open('api_keys.json') as f:
-    api_keys = json.load(f)
+@bp.app_errorhandler(QuotaExceeded)
+def quota_exceeded(error):
+    return jsonify({'error': str(error)}), 429
 
-@app.route('/')
+@bp.app_errorhandler(JobQueueFull)
+def job_queue_full(error):
+    return jsonify({'error': str(error)}), 503, {'Retry-After': '30'}
+
+@bp.route('/')
 def home():
-    return render_template('frontend.html', api_key=api_keys['GMAPS_KEY'])
+    return render_template('frontend.html', api_key=current_app.config['API_KEYS']['GMAPS_KEY'])
+
+#Radius of the nearby-zip fallback of /request-markers, in miles.
+NEARBY_MILES = 5
 
 GMAP_Format = namedtuple('GMAP_Format', ['address', 'geocode', 'rating', 'cashflow', 'listingURL'])
 
+#Responses smaller than this aren't worth compressing.
+COMPRESS_MIN_BYTES = 1024
+
+
+class GeocodeCache:
+    """
+    The {'lat', 'lng'} of every address geocoded so far, saved to the json file "file_name".
+    Every worker process saving to the same file adds to it, and refresh() picks up what the others saved.
+    """
+    def __init__(self, file_name = 'geocodes.json'):
+        self.file_name = file_name
+        self.address_to_geocode = {}
+        self.loaded_mtime = None #of "file_name", when it was last read
+        self.lock = threading.Lock()
+        self._read_file()
+
+    def _read_file(self):
+        """
+        Adds every geocode saved in "file_name" that isn't cached yet, e.g. ones another worker process bought.
+        """
+        if not os.path.exists(self.file_name):
+            return
+        mtime = os.path.getmtime(self.file_name)
+        try:
+            with open(self.file_name, 'r') as file:
+                saved = json.load(file)
+        except ValueError as e:
+            logging.error(f"could not read geocodes {self.file_name}: {e}")
+            return
+        with self.lock:
+            self.loaded_mtime = mtime
+            for address, geocode in saved.items():
+                self.address_to_geocode.setdefault(address, geocode)
+
+    def refresh(self):
+        """
+        Re-reads "file_name" if another worker process saved to it since it was last read.
+        """
+        if os.path.exists(self.file_name) and os.path.getmtime(self.file_name) != self.loaded_mtime:
+            self._read_file()
+
+    def set(self, address, geocode):
+        with self.lock:
+            self.address_to_geocode[address] = geocode
+
+    def save(self):
+        """
+        Saves every geocode to "file_name". What other worker processes saved is merged in first,
+        under a lock on the file, so no save drops geocodes another one paid for.
+        """
+        with file_lock(f'{self.file_name}.lock'):
+            self._read_file()
+            with self.lock:
+                saved = dict(self.address_to_geocode)
+            write_json(self.file_name, saved)
+            self.loaded_mtime = os.path.getmtime(self.file_name)
+
 
 class GmapsInterlinker:
     """
     Interlinks requests from frontend and prettifies backend KealEstate information to be in a palatable format. 
     """
-    def __init__(self):
+    def __init__(self, api_keys, marker_index = None, usage_counter = None, archive = None, geocodes = None,
+                 near_zips_file = 'near_zips.json', near_zip_distances_file = 'near_zip_distances.json'):
+        self.api_keys = api_keys
+        self.marker_index = marker_index
+        self.usage_counter = usage_counter
+        self.archive = archive
+        self.near_zips_file = near_zips_file
+        self.near_zip_distances_file = near_zip_distances_file
         try:
-            file_name = "near_zips.json"
-            with open(file_name, 'r') as file:
+            with open(near_zips_file, 'r') as file:
                 self.base_zip_to_near_zips = json.load(file)
         except FileNotFoundError:
             self.base_zip_to_near_zips = {}  # If the file does not exist, return an empty dictionary
+        try:
+            #base zip -> {'radius': miles searched, 'distances': {zip: miles}}
+            with open(near_zip_distances_file, 'r') as file:
+                self.base_zip_to_zip_distances = json.load(file)
+        except FileNotFoundError:
+            self.base_zip_to_zip_distances = {}
+        self.geocodes = geocodes if geocodes is not None else GeocodeCache()
+        self.address_to_geocode = self.geocodes.address_to_geocode
 
     def _cashflow_to_rating(self, this_cashflow, cashflow_df):
         """
@@ -50,6 +241,8 @@ class GmapsInterlinker:
         and positive cashflow
         """
 
+        import numpy as np
+
         cashflow = cashflow_df['cashflow']
         np_cashflow = np.array(cashflow)
 
@@ -64,6 +257,10 @@ class GmapsInterlinker:
         else:
             return -1
     
+    def _record_call(self, upstream):
+        if self.usage_counter is not None:
+            self.usage_counter.record(upstream)
+
     def _address_to_geocode(self, address):
         """
         Given and address "address", convert it to the gmaps geocded format to give to the front end javascript google maps api.
@@ -71,51 +268,79 @@ class GmapsInterlinker:
         base_url = "https://maps.googleapis.com/maps/api/geocode/json"
         params = {
             "address": address,
-            "key": api_keys['GMAPS_KEY']
+            "key": self.api_keys['GMAPS_KEY']
         }
-        response = requests.get(base_url, params=params)
+        try:
+            response = get_controller("maps.googleapis.com").get(base_url, on_attempt=lambda: self._record_call(GEOCODE), params=params)
+        except UpstreamUnavailable as e:
+            raise GeocodeAPIFailed(f"Geocode API was not called: {e}")
         if response.status_code == 200:
-            return response.json()
+            resp_json = response.json()
+            if self.archive is not None:
+                self.archive.append("geocode", params, resp_json)
+            return resp_json
         else:
-            raise GeocodeAPIFailed(f"Geocode API failed with error code {response.status_code} and message {response.json()}")
+            raise GeocodeAPIFailed(f"Geocode API failed with error code {response.status_code} and message {response.text}")
+
+    def _cached_geocode(self, address):
+        """
+        Returns the {'lat', 'lng'} of "address", only calling the Geocoding API the first time an address is seen.
+        """
+        if address not in self.address_to_geocode:
+            #Another worker process may have bought it already.
+            self.geocodes.refresh()
+        if address not in self.address_to_geocode:
+            geocoded = self._address_to_geocode(address)
+            # Extract the specific latitude and longitude values
+            location = geocoded['results'][0]['geometry']['location']
+            self.geocodes.set(address, {'lat': location['lat'], 'lng': location['lng']})
+        return self.address_to_geocode[address]
 
     def _reformat_for_frontend(self, cashflow_df):
         """
-        Given the cashflow_df, converts each row into data palatable for the frontend 
+        Given the cashflow_df, converts each row into data palatable for the frontend.
+        Every converted listing is also added to the "marker_index" for viewport queries, if there is one.
         """
         listings = []
         for index, row in cashflow_df.iterrows():
             #Convert address to geocode.
             try:
-                geocoded = self._address_to_geocode(row['formattedAddress'])
-            except GeocodeAPIFailed: continue
+                geocode = self._cached_geocode(row['formattedAddress'])
+            except (GeocodeAPIFailed, QuotaExceeded): continue
 
             rating = self._cashflow_to_rating(row['cashflow'], cashflow_df)
 
-            # Extract the specific latitude and longitude values
-            lat = geocoded['results'][0]['geometry']['location']['lat']
-            lng = geocoded['results'][0]['geometry']['location']['lng']
-
             # Create a namedtuple for each listing
             listing = GMAP_Format(
                 address=row['formattedAddress'],
-                geocode={'lat': lat, 'lng': lng}, 
+                geocode=geocode,
                 rating= rating,
                 cashflow= row['cashflow'],
                 listingURL=row['listingURL']
             )
             listings.append(listing._asdict())
+            if self.marker_index is not None:
+                self.marker_index.insert(listing._asdict())
+
+        #Save the geocodes and markers back to file once for the whole batch
+        self.geocodes.save()
+        if self.marker_index is not None:
+            self.marker_index.save()
         return listings
 
     def _get_near_zips(self, base_zip, distance_mi):
         """
-        Given the base zipcode "base_zip" and the radiail distance "distance_mi" will return a list of neighboring zipcodes.
+        Given the base zipcode "base_zip" and the radiail distance "distance_mi" will return a list of neighboring zipcodes,
+        closest first. Distances are cached per base zip, so a wide search is reused by narrower ones but never widens them.
         """
-        
-        if(base_zip in self.base_zip_to_near_zips and len(self.base_zip_to_near_zips[base_zip]) > 0):
+        cached = self.base_zip_to_zip_distances.get(base_zip)
+        if cached is not None and cached['radius'] >= distance_mi:
+            return self._zips_within(base_zip, distance_mi)
+        if cached is None and distance_mi == NEARBY_MILES and len(self.base_zip_to_near_zips.get(base_zip, [])) > 0:
+            #Saved before distances were kept, these lists are all NEARBY_MILES lists.
             return self.base_zip_to_near_zips[base_zip]
-        
-        api_key = api_keys["ZIPCODE_KEY"]
+
+        api_key = self.api_keys["ZIPCODE_KEY"]
         format = 'json'
         zip_codes = str(base_zip)
         distance = distance_mi
@@ -124,71 +349,161 @@ class GmapsInterlinker:
         #ind all US zip codes within a given radius of a zip code. Send a GET request to https://www.zipcodeapi.com/rest/<api_key>/radius.<format>/<zip_code>/<distance>/<units>.
         base_url = "https://www.zipcodeapi.com/rest/{}/radius.{}/{}/{}/{}".format(api_key, format, zip_codes, distance, units)
 
-        response = requests.get(base_url)
+        try:
+            response = get_controller("www.zipcodeapi.com").get(base_url, on_attempt=lambda: self._record_call(ZIPCODE))
+        except UpstreamUnavailable as e:
+            raise ZipAPIFailed(f"Zip API was not called for zip {base_zip}: {e}")
         if response.status_code == 200:
-            return self._process_zip_resp(response.json(), base_zip)
+            resp_json = response.json()
+            if self.archive is not None:
+                self.archive.append("zipRadius", {"zip": zip_codes, "distance": distance, "units": units}, resp_json)
+            return self._process_zip_resp(resp_json, base_zip, distance)
         else:
-            raise ZipAPIFailed(f"Zip API Failed for zip {base_zip} with error code {response.status_code} and message {response.json()}")
+            raise ZipAPIFailed(f"Zip API Failed for zip {base_zip} with error code {response.status_code} and message {response.text}")
 
-    def _process_zip_resp(self, resp_json, base_zip):
+    def _zips_within(self, base_zip, distance_mi):
         """
-        Parses Zipcode API response and adds info into the "base_zip_to_near_zips" dictionary.
+        Returns the cached zipcodes within "distance_mi" miles of "base_zip", closest first, without "base_zip" itself.
         """
-        #convert and sort zipcodes to be by proximity
-        df = pd.DataFrame(resp_json['zip_codes'])
-        df_sorted = df.sort_values(by='distance')
-        new_zipcodes = df_sorted['zip_code'].tolist()
+        distances = self.base_zip_to_zip_distances[base_zip]['distances']
+        return [zip for zip in sorted(distances, key=distances.get) if distances[zip] <= distance_mi and zip != base_zip]
 
-        if base_zip in self.base_zip_to_near_zips:
-            # Ensure new zip codes aren't already recorded
-            for zip in new_zipcodes:
-                if zip not in self.base_zip_to_near_zips[base_zip]:
-                    self.base_zip_to_near_zips[base_zip].append(zip)
-        else:
-            # If base_zip not already in dictionary, just add new_zipcodes list
-            self.base_zip_to_near_zips[base_zip] = new_zipcodes
-        
-        #Remove base zip from the list... if it's not in there, move on.
-        try:
-            self.base_zip_to_near_zips[base_zip].remove(base_zip)
-        except ValueError:
-            pass
+    def _process_zip_resp(self, resp_json, base_zip, distance_mi = NEARBY_MILES):
+        """
+        Parses Zipcode API response for "distance_mi" around "base_zip", caches each zipcode's distance
+        and returns the ones within "distance_mi", closest first.
+        The "base_zip_to_near_zips" fallback list only ever holds the NEARBY_MILES zipcodes.
+        """
+        self.base_zip_to_zip_distances[base_zip] = {
+            'radius': distance_mi,
+            'distances': {near_zip['zip_code']: float(near_zip['distance']) for near_zip in resp_json['zip_codes']},
+        }
+        with open(self.near_zip_distances_file, 'w') as file:
+            json.dump(self.base_zip_to_zip_distances, file)
 
-        # Save back to the file
-        file_name = "near_zips.json"
-        with open(file_name, 'w') as file:
-            json.dump(self.base_zip_to_near_zips, file)
+        if distance_mi >= NEARBY_MILES:
+            self.base_zip_to_near_zips[base_zip] = self._zips_within(base_zip, NEARBY_MILES)
+            # Save back to the file
+            with open(self.near_zips_file, 'w') as file:
+                json.dump(self.base_zip_to_near_zips, file)
 
-        return self.base_zip_to_near_zips[base_zip]
+        return self._zips_within(base_zip, distance_mi)
 
-    def _get_more_listings_in_nearby_zips(self, df, zip, amount_left, keal_estate):
+    def _get_more_listings_in_nearby_zips(self, df, zip, amount_left, keal_estate, planner = None, plan = None, user = None, progress = None, on_found = None):
         """
         Called when original zipcode didn't have enough listings. Calls neighboring zipcodes to fulfill the request.
+        With a "planner", each neighbor's estimated cost is added to "plan" and checked against the budgets first,
+        and the search stops at the first one that doesn't fit.
+        "progress"(zip, scored, total) is called as listings are scored, and "on_found"(df) whenever a zip adds listings.
         """
-        gmaps_converter = GmapsInterlinker()
+        import pandas as pd
 
         #if we haven't gotten the amount we need, then find nearby zips and keep going.
         try:
-            near_zips_list = gmaps_converter._get_near_zips(zip, 5)
+            near_zips_list = self._get_near_zips(zip, NEARBY_MILES)
         except ZipAPIFailed:
             pass
         else:
             #find neighboring zips to finish the job...
             if near_zips_list is not None and amount_left > 0:        
-                keal_estate.listing_failure_count = 0 #reset failure_count since we are in a different zip now
                 #go through each zipcode and look for more poperties
                 for near_zip in near_zips_list:
-                    new_df = keal_estate.get_cashflow_list(near_zip, amount_left)
+                    if amount_left <= 0:
+                        break
+                    if planner is not None:
+                        step = planner.estimate_zip(near_zip, amount_left)
+                        try:
+                            #The steps already run are in today's counts, so only this one is checked against them.
+                            self.usage_counter.check_request(planner.make_plan(plan.steps + [step]))
+                            self.usage_counter.check_budgets(planner.make_plan([step]), user)
+                        except QuotaExceeded as e:
+                            logging.info(f"stopping nearby search at {near_zip}: {e}")
+                            break
+                        plan = planner.make_plan(plan.steps + [step])
+
+                    keal_estate.listing_handler.listing_failure_count = 0 #reset failure_count since we are in a different zip now
+                    zip_progress = None if progress is None else lambda scored, total: progress(near_zip, scored, total)
+                    new_df = keal_estate.get_cashflow_list(near_zip, amount_left, zip_progress)
                     new_df = new_df[~new_df['formattedAddress'].isin(df['formattedAddress'])].dropna()
 
                     #add newly found properties to the list and subtract from amount_left
                     if(len(new_df) > 0):
                         logging.debug(f"found something... len: {len(new_df)} zip {zip} it: {new_df}")
                         df = pd.concat([df, new_df], ignore_index=True)
+                        amount_left -= len(new_df)
+                        if on_found is not None:
+                            on_found(df)
         return df
 
 
-@app.route('/request-markers/<zip>/<int:amount>', methods=['GET'])
+def _columnar(markers):
+    """
+    Packs a list of frontend "markers" into one array per field, dropping the address and URL.
+    Those are fetched lazily from /marker-details/<id> when a marker is clicked.
+    """
+    return {
+        'id': [_marker_index().id_for(marker['address']) for marker in markers],
+        'lat': [round(marker['geocode']['lat'], 6) for marker in markers],
+        'lng': [round(marker['geocode']['lng'], 6) for marker in markers],
+        'rating': [marker['rating'] for marker in markers],
+        'cashflow': [round(float(marker['cashflow'])) for marker in markers],
+    }
+
+def _markers_payload(markers):
+    """
+    Returns "markers" in the format requested by the query arguments:
+    -by default, the list of full GMAP_Format dicts
+    -with format=columnar, compact columnar arrays, clustered for the map's "zoom" level if one is given
+    """
+    if request.args.get('format') != 'columnar':
+        return markers
+
+    zoom = request.args.get('zoom', type=int)
+    clusters = []
+    if zoom is not None:
+        markers, clusters = MarkerIndex.cluster(markers, zoom)
+    return {
+        'markers': _columnar(markers),
+        'clusters': {field: [cluster[field] for cluster in clusters] for field in ('key', 'count', 'lat', 'lng', 'rating', 'cashflow')},
+    }
+
+def _markers_response(markers):
+    return jsonify(_markers_payload(markers))
+
+@bp.after_app_request
+def compress_response(response):
+    """
+    Compresses large json responses with brotli or gzip, whichever the client's Accept-Encoding prefers.
+    """
+    if response.mimetype != 'application/json' or response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    encoding = request.accept_encodings.best_match(offered)
+    if encoding == 'br':
+        response.set_data(brotli.compress(data))
+    elif encoding == 'gzip':
+        response.set_data(gzip.compress(data, compresslevel=6))
+    else:
+        return response
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+@bp.route('/marker-details/<int:marker_id>', methods=['GET'])
+def marker_details(marker_id):
+    """
+    Returns the full frontend json (address, listing's URL, etc.) of a single indexed marker.
+    """
+    marker = _marker_index().get(marker_id)
+    if marker is None:
+        return jsonify({'error': f'no marker with id {marker_id}'}), 404
+    return jsonify(marker)
+
+@bp.route('/request-markers/<zip>/<int:amount>', methods=['GET'])
 def request_markers(zip, amount):
     """
     Returns formatted json string of all information required for frontend including:
@@ -197,25 +512,322 @@ def request_markers(zip, amount):
     -address
     -cashflow
     -listing's URL
+    Accepts format=columnar (and zoom) for the compact, clustered format.
+    Large searches hold the connection for minutes, POST /jobs runs the same search in the background instead.
+    """
+    user = _user()
+    search = _plan_search(zip, amount, request.args.getlist('excludedHomeTypes', type=str), user)
+    return _markers_response(_search_markers(zip, amount, search, user))
+
+def _plan_search(zip, amount, excluded_home_types, user):
+    """
+    Works out the cheapest way to get "amount" listings around "zip" from what's cached, and refuses it with
+    QuotaExceeded if it's over budget. Returns the (keal_estate, gmaps_converter, planner, plan) to run it with.
+    """
+    keal_estate = _keal_estate(excluded_home_types) # Initialize your class
+    gmaps_converter = _gmaps_interlinker()
+    planner = FetchPlanner(keal_estate.listing_handler, gmaps_converter.base_zip_to_near_zips, gmaps_converter.address_to_geocode, keal_estate.on_file_lookup())
+    plan = planner.plan(zip, amount)
+    _usage_counter().check(plan, user)
+    return keal_estate, gmaps_converter, planner, plan
+
+def _search_markers(zip, amount, search, user, job = None):
+    """
+    Runs the planned "search" (see _plan_search) for "amount" listings around "zip", charging its calls to "user",
+    and returns the frontend markers. With a "job", progress is reported to it as listings are scored and the
+    markers found so far after every zip, which is also where a cancelled job stops.
+    """
+    import pandas as pd
+
+    keal_estate, gmaps_converter, planner, plan = search
+    usage_counter = _usage_counter()
+
+    def scoring(zip, scored, total):
+        if job is not None:
+            job.report(zip=zip, scored=scored, toScore=total)
+
+    def found(df):
+        if job is not None:
+            job.report(partial=gmaps_converter._reformat_for_frontend(df), found=len(df))
+
+    with usage_counter.for_user(user):
+        if job is not None:
+            job.report(found=0, wanted=amount)
+        df = None
+        for step in plan.steps:
+            keal_estate.listing_handler.listing_failure_count = 0 #reset failure_count for every zip
+            step_df = keal_estate.get_cashflow_list(step.zip, step.amount, lambda scored, total: scoring(step.zip, scored, total))
+            df = step_df if df is None else pd.concat([df, step_df[~step_df['formattedAddress'].isin(df['formattedAddress'])]], ignore_index=True)
+            found(df)
+
+        #If we haven't gotten enough listings, get more in nearby zipcodes...
+        amount_left = amount - len(df)
+        logging.debug(f"amount left: {amount_left}")
+        if amount_left > 0:
+            df = gmaps_converter._get_more_listings_in_nearby_zips(df, zip, amount_left, keal_estate, planner, plan, user, scoring, found)
+
+        # Transform your listings to the format your frontend needs
+        return gmaps_converter._reformat_for_frontend(df)
+
+def _run_search_job(job, app, zip, amount, search, user):
+    with app.app_context():
+        return _search_markers(zip, amount, search, user, job)
+
+def _job_response(job, status_code = 200):
+    """
+    Returns the job's status and progress, with its markers in the format requested by the query arguments.
+    """
+    snapshot = job.snapshot()
+    snapshot['results'] = _markers_payload(snapshot['results'] or [])
+    return jsonify(snapshot), status_code
+
+@bp.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queues the same search as /request-markers in the background and returns the job to poll at /jobs/<id>.
+    Takes a json body with "zip", "amount" and optionally "excludedHomeTypes". An identical search that is still
+    running or finished recently is returned instead of being run again.
     """
+    body = request.get_json(silent=True) or {}
+    zip = str(body.get('zip', ''))
+    amount = body.get('amount')
+    excluded_home_types = body.get('excludedHomeTypes', [])
+    if (len(zip) != 5 or not zip.isdigit() or not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0
+            or not isinstance(excluded_home_types, list) or not all(isinstance(home_type, str) for home_type in excluded_home_types)):
+        return jsonify({'error': 'zip must be 5 digits, amount a positive integer and excludedHomeTypes a list of strings'}), 400
+
+    key = (zip, amount, tuple(sorted(excluded_home_types)))
+    job = _jobs().find(key)
+    reused = job is not None
+    if not reused:
+        #Plan and check the budget now, so an over budget search is refused right away.
+        user = _user()
+        search = _plan_search(zip, amount, excluded_home_types, user)
+        job, reused = _jobs().submit(key, _run_search_job, current_app._get_current_object(), zip, amount, search, user)
+    response, status_code = _job_response(job, 200 if reused else 202)
+    response.headers['Location'] = f'/jobs/{job.id}'
+    return response, status_code
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Returns the job's status (queued, running, done, failed or cancelled), progress and markers found so far.
+    Accepts the same format/zoom arguments as /request-markers.
+    """
+    job = _jobs().get(job_id)
+    if job is None:
+        return jsonify({'error': f'no job with id {job_id}, it may have expired or belong to another worker process'}), 404
+    return _job_response(job)
+
+@bp.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """
+    Cancels the job, it stops after the listing it is scoring. Markers it already found stay in the index.
+    """
+    job = _jobs().cancel(job_id)
+    if job is None:
+        return jsonify({'error': f'no job with id {job_id}'}), 404
+    return _job_response(job)
+
+@bp.route('/request-top-markers/<zip>/<int:radius>/<int:amount>', methods=['GET'])
+def request_top_markers(zip, radius, amount):
+    """
+    Returns the same frontend json as /request-markers, but for only the "amount" best cashflowing listings
+    found in "zip" and the zipcodes within "radius" miles of it.
+    """
+    if amount <= 0:
+        return jsonify({'error': 'amount must be positive'}), 400
     excluded_home_types = request.args.getlist('excludedHomeTypes', type=str)
-    keal_estate = KealEstate(excluded_home_types) # Initialize your class
-    gmaps_converter = GmapsInterlinker()
+    keal_estate = _keal_estate(excluded_home_types)
+    gmaps_converter = _gmaps_interlinker()
+    usage_counter = _usage_counter()
+    user = _user()
 
-    # Get the base zips cashflow list...
-    df = keal_estate.get_cashflow_list(zip, amount)
-    
-    #If we haven't gotten enough listings, get more in nearby zipcodes...
-    amount_left = amount - len(df)
-    logging.debug(f"amount left: {amount_left}")
-    if amount_left > 0:
-        df = gmaps_converter._get_more_listings_in_nearby_zips(df, zip, amount_left, keal_estate)
-        
-    # Transform your listings to the format your frontend needs
-    transformed_listings = gmaps_converter._reformat_for_frontend(df) 
+    with usage_counter.for_user(user):
+        #Search the base zip first, then its neighbors by proximity.
+        zips = [zip]
+        try:
+            zips += [near_zip for near_zip in gmaps_converter._get_near_zips(zip, radius) if near_zip != zip]
+        except ZipAPIFailed:
+            pass
 
-    # Return the data as JSON
-    return jsonify(transformed_listings)
+        #What is on file is looked up once, for both the plan and the search.
+        on_file = keal_estate.on_file_lookup()
+        planner = FetchPlanner(keal_estate.listing_handler, gmaps_converter.base_zip_to_near_zips, gmaps_converter.address_to_geocode, on_file)
+        usage_counter.check(planner.plan_top_k(zips, amount), user)
+
+        df = keal_estate.get_top_cashflow_list(zips, amount, on_file=on_file)
+        return _markers_response(gmaps_converter._reformat_for_frontend(df))
+
+@bp.route('/markers-in-bounds', methods=['GET'])
+def markers_in_bounds():
+    """
+    Returns the frontend json for every already scored listing inside the lat/lng box given by the
+    "south", "west", "north" and "east" query arguments. Never calls the pipeline or any upstream API.
+    Accepts the same format/zoom arguments as /request-markers.
+    """
+    bounds = {side: request.args.get(side, type=float) for side in ('south', 'west', 'north', 'east')}
+    if None in bounds.values():
+        return jsonify({'error': 'south, west, north and east are required numbers'}), 400
+
+    return _markers_response(_marker_index().query(bounds['south'], bounds['west'], bounds['north'], bounds['east']))
+
+@bp.route('/ops/quota', methods=['GET'])
+def ops_quota():
+    """
+    Returns today's upstream call counters, per upstream and per user, and the configured budgets.
+    """
+    if not _ops_authorized():
+        return jsonify({'error': 'forbidden'}), 403
+    return jsonify(_usage_counter().snapshot())
+
+@bp.route('/ops/upstreams', methods=['GET'])
+def ops_upstreams():
+    """
+    Returns the concurrency limit, circuit breaker state and call counts of every upstream host.
+    """
+    if not _ops_authorized():
+        return jsonify({'error': 'forbidden'}), 403
+    return jsonify(controller_states())
+
+#Caps on the scenario grid: values per axis, scenarios (the product of the axes), and cells of the whole cube.
+MAX_GRID_AXIS = 100
+MAX_GRID_SCENARIOS = 20000
+MAX_GRID_CELLS = 2000000
+
+def _parse_grid_axis(arg_name, default, is_valid, valid_values):
+    """
+    Reads the "arg_name" query values for the scenario grid. Each value is either a number or an inclusive
+    "start:stop:step" range, e.g. interestRates=5:8:0.5. Falls back to "default" when the argument isn't given.
+    Raises ValueError for anything malformed, a range that doesn't go from start up to stop, more than MAX_GRID_AXIS values,
+    or a value "is_valid" rejects, described by "valid_values" in the error.
+    """
+    import numpy as np
+
+    values = []
+    for arg in request.args.getlist(arg_name, type=str):
+        try:
+            parts = [float(part) for part in arg.split(':')]
+        except ValueError:
+            raise ValueError(f'{arg_name} values must be numbers or start:stop:step ranges, got "{arg}"')
+        if len(parts) not in (1, 3) or not all(math.isfinite(part) for part in parts):
+            raise ValueError(f'{arg_name} values must be numbers or start:stop:step ranges, got "{arg}"')
+        if len(parts) == 3:
+            start, stop, step = parts
+            if step <= 0 or stop < start:
+                raise ValueError(f'{arg_name} range "{arg}" needs a positive step and a stop no lower than its start')
+            if (stop - start) / step + 1 > MAX_GRID_AXIS:
+                raise ValueError(f'{arg_name} range "{arg}" has more than {MAX_GRID_AXIS} values')
+            values.extend(np.arange(start, stop + step / 2, step).tolist())
+        else:
+            values.append(parts[0])
+        if len(values) > MAX_GRID_AXIS:
+            raise ValueError(f'{arg_name} has more than {MAX_GRID_AXIS} values')
+        if not all(is_valid(value) for value in values):
+            raise ValueError(f'{arg_name} values must be {valid_values}, got "{arg}"')
+    return values if values else [default]
+
+@bp.route('/scenario-grid/<zip>/<int:amount>', methods=['GET'])
+def scenario_grid(zip, amount):
+    """
+    Returns the cashflow of each listing in "zip" across a grid of financing scenarios, including:
+    -the grid axes (interestRates, downPayments, loanYears, expenseRatios)
+    -each listing's address, zpid and URL
+    -the cashflow cube, indexed [listing][rate][down payment][term][expense ratio]
+    -break-even interest rates, indexed [listing][down payment][term][expense ratio] (null if it never cashflows)
+    """
+    import numpy as np
+
+    excluded_home_types = request.args.getlist('excludedHomeTypes', type=str)
+    keal_estate = _keal_estate(excluded_home_types)
+
+    try:
+        axes = {
+            'interestRates': _parse_grid_axis('interestRates', KealEstate.INTEREST_RATE, lambda rate: 0 <= rate <= 100, 'percentages from 0 to 100'),
+            'downPayments': _parse_grid_axis('downPayments', KealEstate.DOWN_PAYMENT, lambda down: 0 <= down <= 1, 'fractions from 0 to 1'),
+            'loanYears': _parse_grid_axis('loanYears', KealEstate.LOAN_YEARS, lambda years: 0 < years <= 100, 'more than 0 and at most 100 years'),
+            'expenseRatios': _parse_grid_axis('expenseRatios', round(KealEstate.VACANCY_RATE + KealEstate.REPAIRS_RATE + KealEstate.MGMT_RATE, 4),
+                                              lambda ratio: 0 <= ratio < 1, 'fractions from 0 up to (not including) 1'),
+        }
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    scenarios = math.prod(len(values) for values in axes.values())
+    if scenarios > MAX_GRID_SCENARIOS or scenarios * amount > MAX_GRID_CELLS:
+        return jsonify({'error': f'{scenarios} scenarios for {amount} listings is over the limit of {MAX_GRID_SCENARIOS} scenarios and {MAX_GRID_CELLS} cells'}), 400
+
+    planner = FetchPlanner(keal_estate.listing_handler, {}, {}, keal_estate.on_file_lookup())
+    usage_counter = _usage_counter()
+    usage_counter.check(planner.make_plan([planner.estimate_zip(zip, amount, geocode=False)]), _user())
+
+    #Tax and rent are looked up once here; every scenario reuses them.
+    with usage_counter.for_user(_user()):
+        df = keal_estate.get_cashflow_list(zip, amount)
+    #Cached zips can return more listings than asked for, keep the grid within what was checked.
+    df = df.head(amount)
+    cashflow, break_even = keal_estate.calculate_scenario_grid(df, axes['interestRates'], axes['downPayments'], axes['loanYears'], axes['expenseRatios'])
+
+    return jsonify({
+        **axes,
+        'listings': df[['formattedAddress', 'zpid', 'listingURL']].to_dict(orient='records'),
+        'cashflow': np.round(cashflow, 2).tolist(),
+        'breakEvenRates': np.where(np.isnan(break_even), None, np.round(break_even, 3)).tolist(),
+    })
+
+def _parse_date_arg(arg_name, required = False):
+    """
+    Reads the "arg_name" query argument as a YYYY-MM-DD date, None if it isn't given.
+    Raises ValueError if it isn't a date, or is missing when "required".
+    """
+    value = request.args.get(arg_name)
+    if value is None:
+        if required:
+            raise ValueError(f'{arg_name} is required')
+        return None
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError(f'{arg_name} must be a YYYY-MM-DD date')
+
+def _records_response(df):
+    #to_json turns NaN into null and numpy numbers into plain ones.
+    return current_app.response_class(df.to_json(orient='records'), mimetype='application/json')
+
+@bp.route('/history/zpid/<int:zpid>', methods=['GET'])
+def zpid_history(zpid):
+    """
+    Returns the price, rent, expenses, tax and cashflow of the listing "zpid" on every day it was scored,
+    optionally only between the "start" and "end" dates.
+    """
+    try:
+        start, end = _parse_date_arg('start'), _parse_date_arg('end')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return _records_response(_snapshot_store().zpid_trend(zpid, start, end))
+
+@bp.route('/history/zip/<zip>', methods=['GET'])
+def zip_history(zip):
+    """
+    Returns how many listings in "zip" were scored and cashflowed, and their median and mean cashflow,
+    on every day it was scored, optionally only between the "start" and "end" dates.
+    """
+    try:
+        start, end = _parse_date_arg('start'), _parse_date_arg('end')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return _records_response(_snapshot_store().zip_trend(zip, start, end))
+
+@bp.route('/history/turned-positive', methods=['GET'])
+def turned_positive():
+    """
+    Returns the listings that didn't cashflow as of the "since" date but do in their latest score,
+    optionally only in the given "zip"s.
+    """
+    try:
+        since = _parse_date_arg('since', required=True)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    zips = request.args.getlist('zip', type=str) or None
+    return _records_response(_snapshot_store().turned_positive(since, zips))
 
 if __name__ == "__main__":
-    app.run(debug=True) #or just app.run() if you don't want to use debug mode
+    create_app().run(debug=True) #or just app.run() if you don't want to use debug mode
@@ -1,16 +1,11 @@
 import logging
 import glob
-import requests
-import time
 from collections import namedtuple
 import json
-import pandas as pd
 import datetime
 import os
-import time
 from functools import partial
-
-logging.basicConfig(level=logging.CRITICAL)
+from upstream import UpstreamUnavailable, get_controller
 
 class NoMoreAgentsError(Exception):
     """Raised when there are no more agents to fetch."""
@@ -26,77 +21,82 @@ RentalData = namedtuple('RentalData', ['median',	'lowRent',	'highRent',
                                        		'percentile_25',	'percentile_75', 'comparableRents'])
 PageData = namedtuple('PageData', ['current', 'max'])
 
-with open('api_keys.json') as f:
-    api_keys = json.load(f)
+#Where fetched tax and rental data is kept unless configured otherwise, one {address}_tax_{date}.json / {address}_rental_{date}.json file per listing.
+TAX_DIRECTORY = 'tax_data'
+RENTAL_DIRECTORY = 'rental_data'
+
+def load_api_keys(file_name = 'api_keys.json'):
+    """
+    Reads the upstream API keys from the json file "file_name".
+    """
+    with open(file_name) as f:
+        return json.load(f)
 
 class ZillowAPIManager:
-    MAX_RETRIES = 5
-    RATE_LIMIT_PERIOD = 0.5  # 2 requests per second, so 0.5 seconds between requests
+    """
+    Makes the Zillow API calls of one app, so two apps in a process never share keys, counters or archives.
+    """
+    HOST = "zillow-com1.p.rapidapi.com"
 
-    @staticmethod
-    def call_zillow_api(url_suffix, query_string, process_response):
+    def __init__(self, api_keys = None, usage_counter = None, archive = None):
+        """
+        Calls are made with the "api_keys" dictionary (read from api_keys.json on the first call if not given), counted with
+        the "usage_counter" (see quota.py) and their raw responses kept in the ResponseArchive "archive" (see archive.py), if given.
+        """
+        self.api_keys = api_keys
+        self.usage_counter = usage_counter
+        self.archive = archive
+
+    def call_zillow_api(self, url_suffix, query_string, process_response):
         """
         Calls the Zillow API with the url_suffix appended to the end and the query_string passed through.
         """
+        if self.api_keys is None:
+            self.api_keys = load_api_keys()
+
         url = f"https://zillow-com1.p.rapidapi.com/{url_suffix}"
 
         headers = {
-            "X-RapidAPI-Key": api_keys['ZILLOW_KEY'],
-            "X-RapidAPI-Host": "zillow-com1.p.rapidapi.com"
+            "X-RapidAPI-Key": self.api_keys['ZILLOW_KEY'],
+            "X-RapidAPI-Host": self.HOST
         }
 
         logging.info(f"Calling Zillow api for {url_suffix} with query {query_string}")
 
-        last_call_time = 0
-
-        for retry_count in range(ZillowAPIManager.MAX_RETRIES):
-            # Wait if necessary to comply with rate limit
-            time_since_last_call = time.time() - last_call_time
-            if time_since_last_call < ZillowAPIManager.RATE_LIMIT_PERIOD:
-                time.sleep(ZillowAPIManager.RATE_LIMIT_PERIOD - time_since_last_call)
-
-            # Make the request
-            response = requests.get(url, headers=headers, params=query_string)
-            last_call_time = time.time()
-
-            if response.status_code == 200:
-                if url_suffix == "findAgent":
-                    logging.critical(f"{url_suffix} response: {response.json()}\n\n")
-                return process_response(response.json())
-            else:
-                logging.debug(f"API call to {url_suffix} failed with status code {response.status_code}, response {response} and query {query_string}. Retrying...")
-                time.sleep(2 ** retry_count)  # Exponential backoff
+        #Concurrency, 429/Retry-After, 5xx retries and circuit breaking are all handled per upstream host by the controller.
+        try:
+            response = get_controller(self.HOST).get(url, on_attempt=self._record_call, headers=headers, params=query_string)
+        except UpstreamUnavailable as e:
+            raise ZillowAPIFailed(f"API call to {url_suffix} with query {query_string} was not made: {e}")
+
+        if response.status_code == 200:
+            resp_json = response.json()
+            if url_suffix == "findAgent":
+                logging.critical(f"{url_suffix} response: {resp_json}\n\n")
+            #Keep the whole response, the processors only keep a slice of it.
+            if self.archive is not None:
+                self.archive.append(url_suffix, query_string, resp_json)
+            return process_response(resp_json)
 
         raise ZillowAPIFailed(f"API call to {url_suffix} failed with status code {response.status_code}, response {response} and query {query_string}")
 
+    def _record_call(self):
+        if self.usage_counter is not None:
+            self.usage_counter.record('zillow')
+
 
 class DataManager:
     @staticmethod
-    def load_listing_data():
-        listings = []
+    def load_listing_data(store = None):
+        """
+        Returns every current listing, as a list and as a dictionary by zip code, from the ListingStore "store"
+        (the default listing_data one if not given).
+        """
+        from listing_store import ListingStore #imported here, listing_store imports this module.
+
+        store = store if store is not None else ListingStore()
+        listings = store.listings()
         zip_to_listings = {}
-        #-) read listings csvs...
-        # Read each CSV in the listing_data directory
-        listings_directory = os.path.dirname(os.path.realpath(__file__)) + "/listing_data"
-        for filename in os.listdir(listings_directory):
-            logging.debug("Item in directory")
-            if filename.endswith(".csv"):
-                df = pd.read_csv(os.path.join(listings_directory, filename), dtype={'zip': str})
-                for _, row in df.iterrows():
-                    listing = ListingData(
-                        formattedAddress=row['formattedAddress'],
-                        zip=str(row['zip']),
-                        beds=row['beds'],
-                        baths=row['baths'],
-                        price=row['price'],
-                        zpid=row['zpid'],
-                        homeType=row['homeType'],
-                        listingURL=row['listingURL'],
-                    )
-                    logging.debug(row['zip'])
-                    #If we alreayd have this listing, no need to add it again...
-                    if listing not in listings:
-                        listings.append(listing)
 
         #now take that big list of listings and parse it into the dictionary by zip code
         logging.debug("loading old listings")
@@ -125,10 +125,18 @@ class ListingsHandler:
     """
     All code relating to handling, fetching, maintaining Listing Data.
     """
-    def __init__(self, excluded_hometypes):
+    def __init__(self, excluded_hometypes, store = None, zillow = None):
+        """
+        Keeps listings in the ListingStore "store" (the default listing_data one if not given) and fetches new ones
+        through the ZillowAPIManager "zillow" (a default one if not given).
+        """
+        from listing_store import ListingStore #imported here, listing_store imports this module.
+
         self.listing_failure_thresh = 3
         self.listing_failure_count = 0
-        self.listings, self.zip_to_listings = DataManager.load_listing_data()
+        self.store = store if store is not None else ListingStore()
+        self.zillow = zillow if zillow is not None else ZillowAPIManager()
+        self.listings, self.zip_to_listings = DataManager.load_listing_data(self.store)
         self.excluded_hometypes = excluded_hometypes
     
     def get_listings(self, zip, amount):
@@ -174,19 +182,25 @@ class ListingsHandler:
             
             #-3) call get_agent_zuid(zip) to get zuid
             try:
-                agent_handler = AgentHandler()
+                agent_handler = AgentHandler(self.zillow)
                 zuid = agent_handler.get_agent_zuid(zip)
                 logging.debug(f"zuid: {zuid}")
             except (NoMoreAgentsError, ZillowAPIFailed) as e:
                 #if there are no more agents, return what we have... nothing else we can do.
                 return self._hometype_filtered_listings(self.zip_to_listings[zip])
 
-            process_listing_api_partial = partial(self._process_listing_api_resp, zip = zip, zuid = zuid, agent_handler = agent_handler)
+            process_listing_api_partial = partial(self._process_listing_api_resp, zip = zip)
+            found_before = len(self.zip_to_listings[zip])
             #Call API
             try:
-                ZillowAPIManager.call_zillow_api("agentActiveListings", {"zuid":f"{zuid}","page":"1"},process_listing_api_partial ) #can throw ZillowAPIFailed Error  
+                self.zillow.call_zillow_api("agentActiveListings", {"zuid":f"{zuid}","page":"1"},process_listing_api_partial ) #can throw ZillowAPIFailed Error  
             except ZillowAPIFailed as e:
                 continue
+
+            #"failed" refers to failing to find a new listing of the requested zip...
+            if len(self.zip_to_listings[zip]) == found_before:
+                self.listing_failure_count += 1
+                logging.debug(f"failure count incr: {self.listing_failure_count}")
         
 
         return self._hometype_filtered_listings(self.zip_to_listings[zip])
@@ -213,42 +227,36 @@ class ListingsHandler:
             batch.append(listing)
         return batch
 
-    def _process_listing_api_resp(self, resp_json, zip, zuid, agent_handler):
+    def _process_listing_api_resp(self, resp_json, zip):
         """
-        Parses the response from Zillow Listing API and saves the data, then appends it to the "zip_to_listings" dictionary
+        Parses the response from Zillow Listing API and saves the data, then adds it to the "zip_to_listings" dictionary
         """
-        #Append new batch of listings to current set of listings.
         logging.debug(f"resp json {resp_json}")
         batch = self._process_api_batch(resp_json['listings'])
-        self.listings = self.listings + batch
+        statuses = [row.get('home_marketing_status') for row in resp_json['listings']]
 
-        failed = True
+        #Newer data for a zpid we already have replaces it.
         for listing in batch:
-            if listing.zip == zip: failed = False
-            self.zip_to_listings[listing.zip] = self.zip_to_listings[listing.zip] + [listing] if listing.zip in self.zip_to_listings else [listing] 
-        
-        #"failed" refers to failing to find a listing of the requested zip... 
-        if failed:
-            self.listing_failure_count += 1
-            logging.debug(f"failure count incr: {self.listing_failure_count}")
+            zip_listings = [known for known in self.zip_to_listings.get(listing.zip, []) if known.zpid != listing.zpid]
+            self.zip_to_listings[listing.zip] = zip_listings + [listing]
+        batch_zpids = {listing.zpid for listing in batch}
+        self.listings = [known for known in self.listings if known.zpid not in batch_zpids] + batch
 
-        self.save_batch_to_csv(batch, zip, zuid, agent_handler)
+        self.save_batch(batch, statuses)
 
    
-    def save_batch_to_csv(self, batch, zip, zuid, agent_handler):
+    def save_batch(self, batch, statuses):
         """
-        If given batch isn't empty, save it to file.
+        Appends the new or changed listings of the given batch, with their "statuses", to the listing store's delta log.
         """
-        if(len(batch) > 0):
-            #-4) save this batch as a csv. (so that next time it gets added in step 1)
-            batch_df = pd.DataFrame(batch, columns = ListingData._fields) #convert to dictionary then to DataFrame
-            csv_filename = f"listing_data/listing_{zip}_{zuid}_page{agent_handler.zip_to_agentpages[zip].current}_{datetime.datetime.today().strftime('%Y%m%d')}.csv"
-            # save contents
-            batch_df.to_csv(csv_filename, index=False)
+        #-4) (so that next time it gets added in step 1)
+        written = self.store.append_batch(batch, statuses)
+        logging.debug(f"{written} of {len(batch)} listings were new or changed")
 
 class AgentHandler:
     
-    def __init__(self):
+    def __init__(self, zillow = None):
+        self.zillow = zillow if zillow is not None else ZillowAPIManager()
         self.zip_to_zuidlist = {}
         self.zip_to_agentpages = DataManager.load_agent_pages()
 
@@ -301,7 +309,7 @@ class AgentHandler:
         process_agent_api_partial = partial(self._process_agent_api_resp, zip = zip)
 
         #Doing API call...
-        return ZillowAPIManager.call_zillow_api("findAgent", {"locationText":zip, "page":page}, process_agent_api_partial)
+        return self.zillow.call_zillow_api("findAgent", {"locationText":zip, "page":page}, process_agent_api_partial)
         
 
     def _process_agent_api_resp(self, agent_resp_json, zip):
@@ -337,54 +345,61 @@ class AgentHandler:
     
 class TaxHandler:
 
-    @staticmethod
-    def get_tax_data(listing_data):
+    def __init__(self, directory = TAX_DIRECTORY, zillow = None):
+        """
+        Keeps fetched tax data in "directory" and fetches it through the ZillowAPIManager "zillow" (a default one if not given).
+        """
+        self.directory = directory
+        self.zillow = zillow if zillow is not None else ZillowAPIManager()
+
+    def get_tax_data(self, listing_data):
         """
         Given a ListingData namedtuple, "listing_data", will return a TaxData namedtuple with the tax info on the given property.
         """
         #First check to see if file alrady exists, return that if true...
-        found, tax_or_filename = TaxHandler._check_file_for_tax_data(listing_data)
+        found, tax_or_filename = self._check_file_for_tax_data(listing_data)
         if found:
             return tax_or_filename
         #otherwise, call api and return THAT.
         try:
-            return TaxHandler._handle_tax_api(listing_data, tax_or_filename)
+            return self._handle_tax_api(listing_data, tax_or_filename)
         except ZillowAPIFailed:
             return 0
 
-    @staticmethod
-    def _check_file_for_tax_data(listing_data):
+    def _check_file_for_tax_data(self, listing_data):
         """
         Returns success status in finding data on file and either the found tax number, 
         or the requested tax filename depending on the success status.
         """
         sanitized_address = listing_data.formattedAddress.replace('/', '_')
-        tax_filename_pattern = f'tax_data/{sanitized_address}_tax_*.json'
+        tax_filename_pattern = f'{self.directory}/{sanitized_address}_tax_*.json'
         matching_files = glob.glob(tax_filename_pattern)
 
         #defaut tax_filename to what we WANT to name it if it doesn't exist...
-        tax_filename = f'tax_data/{sanitized_address}_tax_{datetime.datetime.today().strftime("%Y%m%d")}.json'
+        tax_filename = f'{self.directory}/{sanitized_address}_tax_{datetime.datetime.today().strftime("%Y%m%d")}.json'
 
         #if previous tax info on this property exists...
         if matching_files and os.path.exists(matching_files[0]):
-            tax_filename = matching_files[0]
-            with open(tax_filename, 'r') as f:
-                tax_data = json.load(f)
-                return True, tax_data['tax']
+            return True, TaxHandler._read_tax_file(matching_files[0])
         
         return False, tax_filename
 
-
     @staticmethod
-    def _handle_tax_api(listing_data, tax_filename):
+    def _read_tax_file(tax_filename):
+        with open(tax_filename, 'r') as f:
+            return json.load(f)['tax']
+
+
+    def _handle_tax_api(self, listing_data, tax_filename):
         """
         Calls Zillow Tax API and outsources the processing of response to _process_tax_api_resp method. Returns tax estimate.
         """
         #-)if not... get zpid from address PropertyData and call API
         #--) save response as the most recent years tax payment and save to json
 
+        os.makedirs(self.directory, exist_ok=True)
         process_tax_api_partial = partial(TaxHandler._process_tax_api_resp, tax_filename = tax_filename)
-        return ZillowAPIManager.call_zillow_api("priceAndTaxHistory", {"zpid":listing_data.zpid}, process_tax_api_partial)
+        return self.zillow.call_zillow_api("priceAndTaxHistory", {"zpid":listing_data.zpid}, process_tax_api_partial)
         
         
     @staticmethod
@@ -412,18 +427,23 @@ class TaxHandler:
 
 class RentalHandler:
 
+    def __init__(self, directory = RENTAL_DIRECTORY, zillow = None):
+        """
+        Keeps fetched rental data in "directory" and fetches it through the ZillowAPIManager "zillow" (a default one if not given).
+        """
+        self.directory = directory
+        self.zillow = zillow if zillow is not None else ZillowAPIManager()
 
-    @staticmethod
-    def get_rental_data(listing_data):
+    def get_rental_data(self, listing_data):
         """
         returns a RentalData namedtuple object given a ListingData namedtuple "listing_data"
         """
 
-        found, rental_or_filename = RentalHandler._check_file_for_rental_data(listing_data)
+        found, rental_or_filename = self._check_file_for_rental_data(listing_data)
         if found:
             return rental_or_filename 
         try:
-            return RentalHandler._handle_rental_api(listing_data, rental_or_filename)
+            return self._handle_rental_api(listing_data, rental_or_filename)
         except ZillowAPIFailed:
             return RentalData(0, 0, 0, 0, 0, 0)
 
@@ -434,8 +454,7 @@ class RentalHandler:
         # Use the _replace method with the ** operator to unpack the dictionary as keyword arguments
         return rental_data._replace(**replacements)
 
-    @staticmethod
-    def _check_file_for_rental_data(listing_data):
+    def _check_file_for_rental_data(self, listing_data):
         """
         Returns success status in finding data on file and either the found rental number, 
         or the requested rental filename depending on the success status.
@@ -443,25 +462,26 @@ class RentalHandler:
         #-) Check if RentalData is already saved for that property in a csv.
         
         sanitized_address = listing_data.formattedAddress.replace('/', '_') #remove characters we can't save a file as.
-        rental_filename_pattern = f'rental_data/{sanitized_address}_rental_*.json'
+        rental_filename_pattern = f'{self.directory}/{sanitized_address}_rental_*.json'
         matching_files = glob.glob(rental_filename_pattern)
-        rental_filename = f'rental_data/{sanitized_address}_rental_{datetime.datetime.today().strftime("%Y%m%d")}.json'
+        rental_filename = f'{self.directory}/{sanitized_address}_rental_{datetime.datetime.today().strftime("%Y%m%d")}.json'
     
         #-) if so... use read that from file and return it as a RentalData
         #if previous rental info exists of this address
         if matching_files and os.path.exists(matching_files[0]):
-            rental_filename = matching_files[0]
-            logging.debug(f"rental exists: {rental_filename}")
-            # Load the dictionary from a JSON file
-            with open(rental_filename, 'r') as f:
-                rental_data_dict = json.load(f)
-            # Convert the dictionary back to a namedtuple
-            rental_data = RentalData(**rental_data_dict)
-            rental_data = RentalHandler._replace_none_with_zero(rental_data)
-            return True, rental_data
+            logging.debug(f"rental exists: {matching_files[0]}")
+            return True, RentalHandler._read_rental_file(matching_files[0])
 
         return False, rental_filename
 
+    @staticmethod
+    def _read_rental_file(rental_filename):
+        # Load the dictionary from a JSON file
+        with open(rental_filename, 'r') as f:
+            rental_data_dict = json.load(f)
+        # Convert the dictionary back to a namedtuple
+        return RentalHandler._replace_none_with_zero(RentalData(**rental_data_dict))
+
     @staticmethod
     def _format_prop_type(prop_type):
         """
@@ -481,8 +501,7 @@ class RentalHandler:
             prop_type = "Townhouse"
         return prop_type
 
-    @staticmethod
-    def _handle_rental_api(listing_data, rental_filename):
+    def _handle_rental_api(self, listing_data, rental_filename):
         """
         Calls Zillow Rental API and returns a RentalData object. Outsources processing to _process_rental_api_resp
         """
@@ -495,7 +514,8 @@ class RentalHandler:
         #Process API callback
         process_rental_api_partial = partial(RentalHandler._process_rental_api_resp, rental_filename = rental_filename)
         #API call...
-        return ZillowAPIManager.call_zillow_api("rentEstimate", {"propertyType":prop_type,"address":full_address,"d":"0.5"}, process_rental_api_partial)
+        os.makedirs(self.directory, exist_ok=True)
+        return self.zillow.call_zillow_api("rentEstimate", {"propertyType":prop_type,"address":full_address,"d":"0.5"}, process_rental_api_partial)
     
     
     @staticmethod
@@ -517,4 +537,48 @@ class RentalHandler:
         with open(rental_filename, 'w') as f:
             json.dump(rental_data_dict, f)
         
-        return rental_data
\ No newline at end of file
+        return rental_data
+
+
+class OnFileLookup:
+    """
+    The tax and rental data already on file for many listings, e.g. every candidate of one search.
+    Each data directory is listed once up front instead of globbed for every listing and check,
+    and each listing's files are read at most once.
+    """
+    def __init__(self, tax_directory = TAX_DIRECTORY, rental_directory = RENTAL_DIRECTORY):
+        self.address_to_tax_file = self._files_by_address(tax_directory, '_tax_')
+        self.address_to_rental_file = self._files_by_address(rental_directory, '_rental_')
+        self.address_to_tax = {}
+        self.address_to_rental = {}
+
+    @staticmethod
+    def _files_by_address(directory, infix):
+        """
+        Returns the sanitized address -> path of the newest {address}{infix}{date}.json file in "directory".
+        """
+        address_to_file = {}
+        for filename in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+            if infix in filename and filename.endswith('.json'):
+                address_to_file[filename.rsplit(infix, 1)[0]] = os.path.join(directory, filename)
+        return address_to_file
+
+    def tax(self, listing_data):
+        """
+        Returns the tax on file for "listing_data", or None if there is none.
+        """
+        address = listing_data.formattedAddress.replace('/', '_')
+        if address not in self.address_to_tax:
+            tax_filename = self.address_to_tax_file.get(address)
+            self.address_to_tax[address] = TaxHandler._read_tax_file(tax_filename) if tax_filename is not None else None
+        return self.address_to_tax[address]
+
+    def rental(self, listing_data):
+        """
+        Returns the RentalData on file for "listing_data", or None if there is none.
+        """
+        address = listing_data.formattedAddress.replace('/', '_')
+        if address not in self.address_to_rental:
+            rental_filename = self.address_to_rental_file.get(address)
+            self.address_to_rental[address] = RentalHandler._read_rental_file(rental_filename) if rental_filename is not None else None
+        return self.address_to_rental[address]
@@ -0,0 +1,194 @@
+import time
+import uuid
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job once it has been cancelled, to unwind its work."""
+    pass
+
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted while the worker pool already has too many waiting."""
+    pass
+
+
+class Job:
+    """
+    One long-running search: its status, progress and partial results, as seen by whoever polls it.
+    The work function is handed the Job and calls report() as it goes, which is also where cancellation takes effect.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    FINISHED = [DONE, FAILED, CANCELLED]
+
+    def __init__(self, key):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = self.QUEUED
+        self.progress = {}
+        self.partial = [] #results found so far, replaced by "result" once done
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cancel_requested = threading.Event()
+        self.lock = threading.Lock()
+
+    def report(self, partial = None, **progress):
+        """
+        Updates the job's progress, and its partial results if "partial" is given.
+        Raises JobCancelled if the job has been cancelled in the meantime.
+        """
+        with self.lock:
+            self.progress.update(progress)
+            if partial is not None:
+                self.partial = partial
+        self.check_cancelled()
+
+    def check_cancelled(self):
+        if self.cancel_requested.is_set():
+            raise JobCancelled(f"job {self.id} was cancelled")
+
+    def _finish(self, status, result = None, error = None):
+        with self.lock:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished_at = time.time()
+
+    def snapshot(self):
+        """
+        Returns the job's status, progress, error and its results, partial until it is done.
+        """
+        with self.lock:
+            return {
+                'id': self.id,
+                'status': self.status,
+                'progress': dict(self.progress),
+                'error': self.error,
+                'results': self.result if self.status == self.DONE else list(self.partial),
+            }
+
+
+class JobManager:
+    """
+    Runs jobs on a bounded local worker pool, so a few slow searches can't tie up every HTTP worker.
+    Jobs are only known to the process that runs them, so every request about a job has to reach that process.
+    -At most "max_workers" jobs run at once and at most "max_queued" wait; past that submit() raises JobQueueFull.
+    -A job submitted with the same key as one that is still running, or finished successfully less than
+     "result_seconds" ago, gets that job back instead of running again.
+    -Finished jobs are kept for "result_seconds", and never more than "max_retained" of them.
+    """
+    def __init__(self, max_workers = 2, max_queued = 20, result_seconds = 3600, max_retained = 200):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.max_queued = max_queued
+        self.result_seconds = result_seconds
+        self.max_retained = max_retained
+        self.jobs = OrderedDict() #id -> Job, oldest first
+        self.key_to_job = {}
+        self.lock = threading.Lock()
+
+    def _reusable(self, job):
+        if job is None or job.cancel_requested.is_set():
+            return False
+        if job.status == Job.DONE:
+            return job.finished_at > time.time() - self.result_seconds
+        return job.status not in Job.FINISHED
+
+    def find(self, key):
+        """
+        Returns the job a new submission of "key" would reuse, or None.
+        """
+        with self.lock:
+            job = self.key_to_job.get(key)
+            return job if self._reusable(job) else None
+
+    def submit(self, key, work, *args):
+        """
+        Queues work(job, *args) under "key" and returns (job, reused), reusing a matching running or finished job if there is one.
+        """
+        with self.lock:
+            self._evict()
+            job = self.key_to_job.get(key)
+            if self._reusable(job):
+                return job, True
+
+            queued = sum(1 for job in self.jobs.values() if job.status == Job.QUEUED)
+            if queued >= self.max_queued:
+                raise JobQueueFull(f"{queued} jobs are already waiting, try again later")
+            job = Job(key)
+            self.jobs[job.id] = job
+            self.key_to_job[key] = job
+        self.executor.submit(self._run, job, work, args)
+        return job, False
+
+    def _run(self, job, work, args):
+        with job.lock:
+            if job.cancel_requested.is_set():
+                job.status = Job.CANCELLED
+                job.finished_at = time.time()
+                return
+            job.status = Job.RUNNING
+        try:
+            result = work(job, *args)
+        except JobCancelled:
+            logging.info(f"job {job.id} cancelled")
+            job._finish(Job.CANCELLED)
+        except Exception as e:
+            logging.exception(f"job {job.id} failed")
+            job._finish(Job.FAILED, error=str(e))
+        else:
+            job._finish(Job.DONE, result=result)
+
+    def get(self, job_id):
+        """
+        Returns the job with "job_id", or None if there is no such job (anymore).
+        """
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancels the job with "job_id": a queued job never starts and a running one stops at its next report().
+        Returns the job, or None if there is no such job.
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancel_requested.set()
+        with job.lock:
+            if job.status == Job.QUEUED:
+                job.status = Job.CANCELLED
+                job.finished_at = time.time()
+        return job
+
+    def _evict(self):
+        """
+        Drops finished jobs past "result_seconds", then the oldest finished ones past "max_retained". Called with the lock held.
+        """
+        expired = time.time() - self.result_seconds
+        finished = [job for job in self.jobs.values() if job.status in Job.FINISHED]
+        excess = len(finished) - self.max_retained
+        for job in finished:
+            if job.finished_at < expired or excess > 0:
+                excess -= 1
+                del self.jobs[job.id]
+                if self.key_to_job.get(job.key) is job:
+                    del self.key_to_job[job.key]
+
+    def shutdown(self):
+        """
+        Cancels every job and waits for the running ones to stop.
+        """
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            self.cancel(job.id)
+        self.executor.shutdown(wait=True)
@@ -1,9 +1,9 @@
 import json
-import pandas as pd
-import datetime
-import os
+import heapq
+import itertools
 import logging
-from handlers import ListingData, PageData, RentalData, ListingsHandler, RentalHandler, TaxHandler 
+from handlers import ListingData, PageData, RentalData, ListingsHandler, OnFileLookup, RentalHandler, TaxHandler, ZillowAPIManager, RENTAL_DIRECTORY, TAX_DIRECTORY
+from snapshot_store import CashflowSnapshotStore
 
 class PropertyUtility:
     @staticmethod
@@ -22,67 +22,249 @@ class PropertyUtility:
 
         return mortgage_payment
 
+    @staticmethod
+    def calculate_mortgage_grid(principal, interest_rate, years):
+        """
+        Same as calculate_mortgage, but broadcasts over numpy arrays of "principal", "interest_rate" and "years"
+        and handles a 0% "interest_rate".
+        """
+        import numpy as np
+
+        monthly_rate = np.asarray(interest_rate, dtype=float) / 12 / 100
+        n_payments = np.asarray(years, dtype=float) * 12
+        growth = (1 + monthly_rate) ** n_payments
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mortgage_payment = principal * (monthly_rate * growth) / (growth - 1)
+        return np.where(monthly_rate == 0, principal / n_payments, mortgage_payment)
+
 
 class KealEstate:
+    #Financing and expense assumptions used when scoring a listing.
+    INTEREST_RATE = 6.8
+    LOAN_YEARS = 30
+    DOWN_PAYMENT = .2
+    VACANCY_RATE = .05
+    REPAIRS_RATE = .05
+    MGMT_RATE = .11
+    CAPEX = 183 #hardcoded monthly
+    #Guessing the most a listing we have no rental data for yet could rent for, when pruning the top-K search:
+    #its price times the highest rent-to-price ratio seen in its zip (with a margin), or a default ratio until
+    #the zip has enough cached rents, never more than the flat ceiling.
+    PLAUSIBLE_RENT_CEILING = 6000
+    DEFAULT_RENT_TO_PRICE = .015
+    RENT_TO_PRICE_MARGIN = 1.25
+    MIN_RENT_SAMPLES = 3
 
-    def __init__(self, excluded_homeTypes = None):
+    def __init__(self, excluded_homeTypes = None, snapshot_store = None, listing_store = None, zillow = None,
+                 tax_directory = TAX_DIRECTORY, rental_directory = RENTAL_DIRECTORY):
+        """
+        Scores listings from the ListingStore "listing_store", with the tax and rental data kept in "tax_directory" and
+        "rental_directory", fetching whatever is missing through the ZillowAPIManager "zillow" (defaults for any not given).
+        """
         self.excluded_hometypes = [home_type.lower() for home_type in excluded_homeTypes] if excluded_homeTypes is not None else []
         
-        self.listing_handler = ListingsHandler(excluded_homeTypes)
-
-        #self.api_count = 0
+        zillow = zillow if zillow is not None else ZillowAPIManager()
+        self.listing_handler = ListingsHandler(excluded_homeTypes, listing_store, zillow)
+        self.tax_handler = TaxHandler(tax_directory, zillow)
+        self.rental_handler = RentalHandler(rental_directory, zillow)
+        self.tax_directory = tax_directory
+        self.rental_directory = rental_directory
+        #every scored list is kept, by day and zip, for historical queries.
+        self.snapshot_store = snapshot_store if snapshot_store is not None else CashflowSnapshotStore()
 
 
-    def get_cashflow_list(self, zip, property_count):
+    def get_cashflow_list(self, zip, property_count, progress = None):
         """
         Returns a list of "property_count" size of properties within the given a zipcode "zip" with cashflow estimates calculated
+        "progress"(scored, total), if given, is called after each listing is scored.
         """
+        import pandas as pd
+
         listings = self.listing_handler.get_listings(zip, property_count)
         data = []
-        #Adding extra columns to the ListingData namedtuple for our extra cashflow information.
-        columns = list(ListingData._fields) + ['rent', 'expenses', 'tax', 'cashflow'] 
         for listing in listings:
-            tax = TaxHandler.get_tax_data(listing)
-            rental = RentalHandler.get_rental_data(listing)
-            expenses = self.calculate_expenses(listing, tax, rental)
-
-            #calculate cashflow as rental income - expenses...
-            cashflow = rental.median - expenses
-
-            #Add to cashflow list
-            entry = listing._asdict()
-            entry['rent'] = rental.median
-            entry['expenses'] = expenses
-            entry['tax'] = tax
-            entry['cashflow'] = cashflow
-            data.append(entry)
+            data.append(self._score_listing(listing))
+            if progress is not None:
+                progress(len(data), len(listings))
         
         #convert to dataframe and sort.
-        df = pd.DataFrame(data, columns=columns)
+        df = pd.DataFrame(data, columns=self._cashflow_columns())
         df_sorted = df.sort_values(by='cashflow', ascending=False)
-        cashflowlist_name = f'cashflow_data/{zip}_count{property_count}_{datetime.datetime.today().strftime("%Y%m%d")}.csv'
-        if not os.path.exists(cashflowlist_name):
-            df_sorted.to_csv(cashflowlist_name, index=False)
+        self.snapshot_store.append(df_sorted)
         return df_sorted
 
+    def get_top_cashflow_list(self, zips, k, rent_ceiling = None, on_file = None):
+        """
+        Returns the "k" best cashflowing properties found across the zipcodes in "zips", best first.
+        -Zips are streamed one at a time and only the current top "k" are kept in a bounded heap.
+        -Listings whose estimated best case cashflow can't beat the current k-th best are never sent to the tax/rental APIs.
+         Unknown rents are estimated per listing (see _rent_ceiling) unless a flat "rent_ceiling" is given, so this is
+         a heuristic: a listing renting for far more than its zip's others could be skipped.
+        The tax and rent already on file are looked up through "on_file", an OnFileLookup that can be shared with the
+        search's FetchPlanner (a new one from on_file_lookup() by default).
+        """
+        import pandas as pd
+
+        if k <= 0:
+            raise ValueError(f"k must be positive, got {k}")
+        on_file = on_file if on_file is not None else self.on_file_lookup()
+        heap = [] #min-heap of (cashflow, tiebreak, entry), heap[0] is the k-th best so far.
+        tiebreak = itertools.count()
+        seen_addresses = set()
+        for zip in zips:
+            #reset failure_count since we are in a different zip now
+            self.listing_handler.listing_failure_count = 0
+            listings = [listing for listing in self.listing_handler.get_listings(zip, k) if listing.formattedAddress not in seen_addresses]
+            seen_addresses.update(listing.formattedAddress for listing in listings)
+
+            #Most promising listings first so the bound cuts off as early as possible.
+            rent_to_price = self._rent_to_price_ceiling(listings, on_file)
+            bounded = sorted(((self._cashflow_upper_bound(listing, rent_ceiling if rent_ceiling is not None else self._rent_ceiling(listing, rent_to_price), on_file), listing)
+                              for listing in listings), key=lambda pair: pair[0], reverse=True)
+            for bound, listing in bounded:
+                if len(heap) >= k and bound <= heap[0][0]:
+                    logging.debug(f"pruning remaining candidates in {zip} at bound {bound}")
+                    break
+                entry = self._score_listing(listing)
+                item = (entry['cashflow'], next(tiebreak), entry)
+                if len(heap) < k:
+                    heapq.heappush(heap, item)
+                elif item[0] > heap[0][0]:
+                    heapq.heapreplace(heap, item)
+
+        data = [entry for _, _, entry in sorted(heap, key=lambda item: item[0], reverse=True)]
+        return pd.DataFrame(data, columns=self._cashflow_columns())
+
+    def on_file_lookup(self):
+        """
+        Returns a new OnFileLookup of the tax and rental data on file in this KealEstate's directories.
+        """
+        return OnFileLookup(self.tax_directory, self.rental_directory)
+
+    def calculate_scenario_grid(self, cashflow_df, interest_rates, down_payments, loan_years, expense_ratios):
+        """
+        Evaluates the cashflow of every listing in "cashflow_df" (as returned by get_cashflow_list) at every combination of
+        "interest_rates" (percent), "down_payments" (fraction), "loan_years" and "expense_ratios" (vacancy + repairs + management
+        as a fraction of rent) in one broadcast, reusing the rent and tax already on the frame.
+        Returns the cashflow cube shaped (listing, rate, down payment, term, expense ratio) and the break-even interest rates
+        shaped (listing, down payment, term, expense ratio). Break-even is NaN where no rate, not even 0%, cashflows.
+        """
+        import numpy as np
+
+        #Axes: listing, rate, down payment, term, expense ratio.
+        price = cashflow_df['price'].to_numpy(dtype=float)[:, None, None, None, None]
+        rent = cashflow_df['rent'].to_numpy(dtype=float)[:, None, None, None, None]
+        tax = cashflow_df['tax'].to_numpy(dtype=float)[:, None, None, None, None]
+        rates = np.asarray(interest_rates, dtype=float)[None, :, None, None, None]
+        downs = np.asarray(down_payments, dtype=float)[None, None, :, None, None]
+        terms = np.asarray(loan_years, dtype=float)[None, None, None, :, None]
+        ratios = np.asarray(expense_ratios, dtype=float)[None, None, None, None, :]
+
+        principal = (1 - downs) * price
+        #Everything the rent has left over once non-mortgage expenses are paid.
+        available = rent * (1 - ratios) - tax / 12 - self.CAPEX
+        cashflow = available - PropertyUtility.calculate_mortgage_grid(principal, rates, terms)
+
+        break_even = self._break_even_rates(principal[:, 0], available[:, 0], terms[:, 0])
+        return cashflow, break_even
+
+    def _break_even_rates(self, principal, available, years, max_rate = 100, iterations = 60):
+        """
+        Bisects for the interest rate at which the mortgage on "principal" uses up exactly "available", for every element at once.
+        Rates above "max_rate" are capped to it.
+        """
+        import numpy as np
+
+        shape = np.broadcast_shapes(np.shape(principal), np.shape(available), np.shape(years))
+        low = np.zeros(shape)
+        high = np.full(shape, float(max_rate))
+        for _ in range(iterations):
+            mid = (low + high) / 2
+            affordable = PropertyUtility.calculate_mortgage_grid(principal, mid, years) <= available
+            low = np.where(affordable, mid, low)
+            high = np.where(affordable, high, mid)
+
+        #Mortgages only grow with rate, so if 0% doesn't cashflow nothing will.
+        never = PropertyUtility.calculate_mortgage_grid(principal, 0, years) > available
+        return np.where(never, np.nan, low)
+
+    def _cashflow_columns(self):
+        """
+        Adding extra columns to the ListingData namedtuple for our extra cashflow information.
+        """
+        return list(ListingData._fields) + ['rent', 'expenses', 'tax', 'cashflow']
+
+    def _score_listing(self, listing):
+        """
+        Fetches the tax and rental data of "listing" and returns it as a dict with its cashflow estimates added.
+        """
+        tax = self.tax_handler.get_tax_data(listing)
+        rental = self.rental_handler.get_rental_data(listing)
+        expenses = self.calculate_expenses(listing, tax, rental)
+
+        #calculate cashflow as rental income - expenses...
+        cashflow = rental.median - expenses
+
+        entry = listing._asdict()
+        entry['rent'] = rental.median
+        entry['expenses'] = expenses
+        entry['tax'] = tax
+        entry['cashflow'] = cashflow
+        return entry
+
+    def _rent_to_price_ceiling(self, listings, on_file):
+        """
+        Returns the highest monthly rent-to-price ratio among the rents on file for "listings" (looked up in "on_file"),
+        with RENT_TO_PRICE_MARGIN on top, or DEFAULT_RENT_TO_PRICE if fewer than MIN_RENT_SAMPLES of them have one.
+        """
+        ratios = []
+        for listing in listings:
+            rental = on_file.rental(listing)
+            if rental is not None and rental.median > 0 and listing.price and listing.price > 0:
+                ratios.append(rental.median / listing.price)
+        if len(ratios) < self.MIN_RENT_SAMPLES:
+            return self.DEFAULT_RENT_TO_PRICE
+        return max(ratios) * self.RENT_TO_PRICE_MARGIN
+
+    def _rent_ceiling(self, listing, rent_to_price):
+        """
+        Returns the most "listing" is plausibly renting for at "rent_to_price", capped at PLAUSIBLE_RENT_CEILING.
+        """
+        if not listing.price or listing.price <= 0:
+            return self.PLAUSIBLE_RENT_CEILING
+        return min(self.PLAUSIBLE_RENT_CEILING, listing.price * rent_to_price)
+
+    def _cashflow_upper_bound(self, listing, rent_ceiling, on_file):
+        """
+        Returns an optimistic estimate of the cashflow of "listing", using only data that is free to get: the mortgage from its price,
+        and the rent/tax already on file (looked up in "on_file"). Unknown rent is assumed to be "rent_ceiling" and unknown tax
+        to be the -1 sentinel. It's only a true bound when the listing's rent really is at most "rent_ceiling".
+        """
+        rental = on_file.rental(listing)
+        rent = rental.median if rental is not None else rent_ceiling
+        tax = on_file.tax(listing)
+        tax = tax if tax is not None else -1
 
+        mortgage = PropertyUtility.calculate_mortgage((1 - self.DOWN_PAYMENT) * listing.price, self.INTEREST_RATE, self.LOAN_YEARS)
+        rent_ratio = 1 - self.VACANCY_RATE - self.REPAIRS_RATE - self.MGMT_RATE
+        return rent * rent_ratio - mortgage - tax / 12 - self.CAPEX
         
     def calculate_expenses(self, listing_data: ListingData, tax, rental_data: RentalData):
         """
         Calculate the expenses of a listing "listing_data" given its tax and rental information, "tax" and "rental_data"
         """
 
-        mortgage = PropertyUtility.calculate_mortgage(.8 * listing_data.price, 6.8 ,30)
+        mortgage = PropertyUtility.calculate_mortgage((1 - self.DOWN_PAYMENT) * listing_data.price, self.INTEREST_RATE, self.LOAN_YEARS)
         logging.debug(f"mortgage: {mortgage}")
-        vacancy = .05 * rental_data.median
+        vacancy = self.VACANCY_RATE * rental_data.median
         logging.debug(f"vacancy: {vacancy}")
-        repairs = .05 * rental_data.median
+        repairs = self.REPAIRS_RATE * rental_data.median
         logging.debug(f"repairs: {repairs}")
         tax /= 12
         logging.debug(f"tax: {tax}")
-        capex = 183 #hardcoded
+        capex = self.CAPEX
         logging.debug(f"capex: {capex}")
-        mgmt = .11 * rental_data.median
+        mgmt = self.MGMT_RATE * rental_data.median
         logging.debug(f"management: {mgmt}")
         total = mortgage + vacancy + repairs + tax + capex + mgmt
         logging.debug(f"total {total}")
@@ -0,0 +1,246 @@
+import os
+import json
+import math
+import glob
+import datetime
+import time
+import threading
+import logging
+from handlers import ListingData
+from safe_files import replacing
+
+LISTINGS_DIRECTORY = os.path.dirname(os.path.realpath(__file__)) + "/listing_data"
+LOG_FILE = 'delta.jsonl'
+
+
+class ListingStore:
+    """
+    zpid-keyed listing storage: one sorted snapshot plus an append-only delta log of what changed since.
+    -Writes only append the listings that are new or whose fields (price, status, ...) changed to delta.jsonl.
+    -compact() folds the log into snapshot.csv, keeping one current row per zpid, and moves every
+     price/status change into price_history.csv.
+    -Reads load the snapshot and replay the (small) log tail.
+    The old per-page listing_*.csv files are still read, and are folded in and removed by the first compaction.
+    """
+    SNAPSHOT_FILE = 'snapshot.csv'
+    HISTORY_FILE = 'price_history.csv'
+    LOCK_FILE = 'compact.lock'
+    STALE_LOCK_SECONDS = 3600 #a lock this old was left by a compaction that crashed
+    COLUMNS = list(ListingData._fields) + ['status', 'updatedAt']
+    HISTORY_COLUMNS = ['zpid', 'at', 'field', 'old', 'new']
+
+    def __init__(self, directory = LISTINGS_DIRECTORY, log_file = LOG_FILE):
+        self.directory = directory
+        self.log_file = log_file
+        self.lock = threading.Lock()
+        self.zpid_to_row = {} #zpid -> {'listing': ListingData, 'status': str, 'updatedAt': str}
+        self.log_changes = [] #price/status changes still in the log
+        self._load()
+
+    def _path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    @staticmethod
+    def _missing_to_none(value):
+        #A missing value comes back from a csv as NaN or an empty string, and NaN never equals anything.
+        return None if value == '' or (isinstance(value, float) and math.isnan(value)) else value
+
+    @staticmethod
+    def _listing_from_dict(row):
+        """
+        Returns the ListingData of "row", a dict read from a csv or the log, with every missing value as None
+        like the API gives it, so an unchanged listing compares equal.
+        """
+        missing_to_none = ListingStore._missing_to_none
+        return ListingData(
+            formattedAddress=missing_to_none(row['formattedAddress']),
+            zip=str(row['zip']),
+            beds=missing_to_none(row['beds']),
+            baths=missing_to_none(row['baths']),
+            price=missing_to_none(row['price']),
+            zpid=int(row['zpid']),
+            homeType=missing_to_none(row['homeType']),
+            listingURL=missing_to_none(row['listingURL']),
+        )
+
+    def _legacy_files(self):
+        #oldest first, they are named listing_{zip}_{zuid}_page{n}_{date}.csv
+        return sorted(glob.glob(self._path('listing_*.csv')), key=lambda name: (name.rsplit('_', 1)[-1], name))
+
+    @staticmethod
+    def _legacy_date(filename):
+        """
+        Returns the YYYY-MM-DD date at the end of a legacy page file's name, or None if it has none.
+        """
+        date = os.path.basename(filename).rsplit('_', 1)[-1][:-len('.csv')]
+        return f'{date[:4]}-{date[4:6]}-{date[6:]}' if len(date) == 8 and date.isdigit() else None
+
+    def _load(self):
+        """
+        Loads the current state: legacy page files, then the snapshot, then the log tail on top.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        import pandas as pd
+
+        for filename in self._legacy_files():
+            #Price changes between the old page files are history too, dated by the file that saw the new price.
+            at = self._legacy_date(filename)
+            for row in pd.read_csv(filename, dtype={'zip': str}).to_dict(orient='records'):
+                self.log_changes.extend(self._apply(self._listing_from_dict(row), None, at))
+
+        if os.path.exists(self._path(self.SNAPSHOT_FILE)):
+            snapshot = pd.read_csv(self._path(self.SNAPSHOT_FILE), dtype={'zip': str, 'status': str, 'updatedAt': str}, keep_default_na=False, na_values={'beds': [''], 'baths': [''], 'price': ['']})
+            for row in snapshot.to_dict(orient='records'):
+                self.zpid_to_row[int(row['zpid'])] = {'listing': self._listing_from_dict(row), 'status': row['status'] or None, 'updatedAt': row['updatedAt'] or None}
+
+        #A log being compacted right now hasn't reached the snapshot yet.
+        log_files = [LOG_FILE + '.compacting', LOG_FILE] if self.log_file == LOG_FILE else [self.log_file]
+        for record in (record for log_file in log_files for record in self._read_log(self._path(log_file))):
+            self.log_changes.extend(self._apply(self._listing_from_dict(record['listing']), record['status'], record['at']))
+
+    @staticmethod
+    def _read_log(path):
+        if not os.path.exists(path):
+            return []
+        records = []
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    #a torn last line from a crashed writer, everything before it is still good.
+                    logging.warning(f"skipping unreadable line in {path}")
+        return records
+
+    def _apply(self, listing, status, at):
+        """
+        Makes "listing" the current row of its zpid and returns its price/status changes, if any.
+        """
+        old = self.zpid_to_row.get(listing.zpid)
+        self.zpid_to_row[listing.zpid] = {'listing': listing, 'status': status, 'updatedAt': at}
+        if old is None:
+            return []
+        changes = []
+        if old['listing'].price != listing.price:
+            changes.append({'zpid': listing.zpid, 'at': at, 'field': 'price', 'old': old['listing'].price, 'new': listing.price})
+        if old['status'] != status and old['status'] is not None and status is not None:
+            changes.append({'zpid': listing.zpid, 'at': at, 'field': 'status', 'old': old['status'], 'new': status})
+        return changes
+
+    def append_batch(self, batch, statuses = None):
+        """
+        Appends the listings of "batch" that are new or changed to the delta log, with their "statuses" if given.
+        Returns how many were written.
+        """
+        statuses = statuses or [None] * len(batch)
+        at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        lines = []
+        with self.lock:
+            for listing, status in zip(batch, statuses):
+                listing = self._listing_from_dict(listing._asdict())
+                current = self.zpid_to_row.get(listing.zpid)
+                if current is not None and current['listing'] == listing and current['status'] == status:
+                    continue
+                self.log_changes.extend(self._apply(listing, status, at))
+                lines.append(json.dumps({'zpid': listing.zpid, 'at': at, 'status': status, 'listing': listing._asdict()}, default=str) + '\n')
+
+            if lines:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(self._path(self.log_file), 'a') as f:
+                    f.write(''.join(lines))
+        return len(lines)
+
+    def listings(self):
+        """
+        Returns the current ListingData of every zpid.
+        """
+        with self.lock:
+            return [row['listing'] for row in self.zpid_to_row.values()]
+
+    def price_history(self, zpid):
+        """
+        Returns every recorded price/status change of "zpid", oldest first, with the old and new values as strings.
+        """
+        import pandas as pd
+
+        changes = []
+        if os.path.exists(self._path(self.HISTORY_FILE)):
+            history = pd.read_csv(self._path(self.HISTORY_FILE), dtype={'at': str, 'field': str, 'old': str, 'new': str})
+            changes = history[history['zpid'] == zpid].to_dict(orient='records')
+        with self.lock:
+            changes += [{**change, 'old': str(change['old']), 'new': str(change['new'])} for change in self.log_changes if change['zpid'] == zpid]
+        return changes
+
+    def compact(self):
+        """
+        Merges the legacy page files, snapshot and delta log into a new snapshot sorted by zpid, appends the
+        log's price/status changes to the history, then removes the merged log and legacy files.
+        Returns False without doing anything if another process is already compacting.
+        """
+        import pandas as pd
+
+        if not os.path.isdir(self.directory):
+            return True
+        lock_path = self._path(self.LOCK_FILE)
+        if os.path.exists(lock_path) and os.path.getmtime(lock_path) < time.time() - self.STALE_LOCK_SECONDS:
+            logging.warning(f"removing stale compaction lock {lock_path}")
+            os.remove(lock_path)
+        try:
+            lock_fd = os.open(self._path(self.LOCK_FILE), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        try:
+            #Rotate the log first so appends made while compacting land in a fresh one.
+            compacting = LOG_FILE + '.compacting'
+            if os.path.exists(self._path(LOG_FILE)) and not os.path.exists(self._path(compacting)):
+                os.replace(self._path(LOG_FILE), self._path(compacting))
+
+            legacy_files = self._legacy_files()
+            merged = ListingStore(self.directory, compacting)
+            changes = merged.log_changes
+
+            rows = [{**row['listing']._asdict(), 'status': row['status'], 'updatedAt': row['updatedAt']} for row in merged.zpid_to_row.values()]
+            snapshot_df = pd.DataFrame(rows, columns=self.COLUMNS).sort_values(by='zpid')
+            with replacing(self._path(self.SNAPSHOT_FILE)) as tmp_path:
+                snapshot_df.to_csv(tmp_path, index=False)
+
+            if changes:
+                history_path = self._path(self.HISTORY_FILE)
+                pd.DataFrame(changes, columns=self.HISTORY_COLUMNS).to_csv(history_path, mode='a', index=False, header=not os.path.exists(history_path))
+
+            #Everything they held is in the snapshot now.
+            for filename in legacy_files + [self._path(compacting)]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+            logging.info(f"compacted {len(rows)} listings, {len(changes)} changes, {len(legacy_files)} legacy files")
+        finally:
+            os.close(lock_fd)
+            os.remove(self._path(self.LOCK_FILE))
+
+        with self.lock:
+            #Our own view stays the same, only the log it came from moved into the snapshot.
+            self.log_changes = [change for change in self.log_changes if change not in changes]
+        return True
+
+    @staticmethod
+    def start_compaction(interval_seconds, directory = LISTINGS_DIRECTORY):
+        """
+        Starts a daemon thread that compacts the listings in "directory" every "interval_seconds".
+        """
+        def compact_forever():
+            stop = threading.Event()
+            while not stop.wait(interval_seconds):
+                try:
+                    ListingStore(directory).compact()
+                except Exception as e:
+                    logging.error(f"listing compaction failed: {e}")
+
+        thread = threading.Thread(target=compact_forever, name='listing-compaction', daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == "__main__":
+    #Run a single compaction, e.g. from cron.
+    ListingStore().compact()
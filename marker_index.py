@@ -0,0 +1,199 @@
+import json
+import math
+import hashlib
+import os
+import threading
+import logging
+from safe_files import file_lock, write_json
+
+
+class MarkerIndex:
+    """
+    Grid spatial index over already scored and geocoded frontend markers, so a map viewport can be answered
+    without running the listing pipeline or calling any upstream API.
+    Every worker process saving to the same "file_name" adds to it, and picks up what the others saved when it changes.
+    """
+    CELL_DEGREES = 0.05 #roughly 3.5 miles of latitude per cell
+    CLUSTER_CELL_PIXELS = 60 #markers closer than this on screen are drawn as one cluster
+
+    def __init__(self, file_name = None):
+        self.file_name = file_name
+        self.address_to_marker = {}
+        self.cell_to_addresses = {}
+        #Ids so the frontend can fetch a marker's details lazily, the same in every worker process.
+        self.address_to_id = {}
+        self.id_to_address = {}
+        self.loaded_mtime = None #of "file_name", when it was last read
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def load(file_name):
+        """
+        Loads a MarkerIndex from the json file "file_name". Starts empty if the file doesn't exist yet, or can't be read.
+        """
+        index = MarkerIndex(file_name)
+        index._read_file()
+        return index
+
+    def _read_file(self):
+        """
+        Inserts every marker saved in "file_name" that isn't indexed yet, e.g. ones another worker process saved.
+        """
+        if self.file_name is None or not os.path.exists(self.file_name):
+            return
+        mtime = os.path.getmtime(self.file_name)
+        try:
+            with open(self.file_name, 'r') as f:
+                markers = json.load(f)
+        except ValueError as e:
+            logging.error(f"could not read marker index {self.file_name}: {e}")
+            return
+        with self.lock:
+            self.loaded_mtime = mtime
+            for marker in markers:
+                if marker['address'] not in self.address_to_marker:
+                    self._insert(marker)
+
+    def _refresh(self):
+        """
+        Re-reads "file_name" if another worker process saved to it since it was last read.
+        """
+        if self.file_name is not None and os.path.exists(self.file_name) and os.path.getmtime(self.file_name) != self.loaded_mtime:
+            self._read_file()
+
+    def save(self):
+        """
+        Saves every marker to "file_name" so the index survives restarts. What other worker processes saved
+        is merged in first, under a lock on the file, so no save drops another's markers.
+        """
+        if self.file_name is None:
+            return
+        with file_lock(f'{self.file_name}.lock'):
+            self._read_file()
+            with self.lock:
+                markers = list(self.address_to_marker.values())
+            write_json(self.file_name, markers)
+            self.loaded_mtime = os.path.getmtime(self.file_name)
+
+    def insert(self, marker):
+        """
+        Adds or replaces the frontend "marker" (a GMAP_Format dict) keyed by its address.
+        """
+        with self.lock:
+            self._insert(marker)
+
+    def _insert(self, marker):
+        address = marker['address']
+        #drop the old position if this address was indexed before.
+        old = self.address_to_marker.get(address)
+        if old is not None:
+            old_cell = self._cell(old['geocode']['lat'], old['geocode']['lng'])
+            self.cell_to_addresses[old_cell].discard(address)
+            if not self.cell_to_addresses[old_cell]:
+                del self.cell_to_addresses[old_cell]
+
+        self.address_to_marker[address] = marker
+        if address not in self.address_to_id:
+            marker_id = self.marker_id(address)
+            self.address_to_id[address] = marker_id
+            self.id_to_address[marker_id] = address
+        cell = self._cell(marker['geocode']['lat'], marker['geocode']['lng'])
+        self.cell_to_addresses.setdefault(cell, set()).add(address)
+
+    @staticmethod
+    def marker_id(address):
+        """
+        Returns the id of "address": 48 bits of its sha1, small enough for a javascript number.
+        """
+        return int(hashlib.sha1(address.encode()).hexdigest()[:12], 16)
+
+    def id_for(self, address):
+        """
+        Returns the id of the marker at "address", or None if it isn't indexed.
+        """
+        return self.address_to_id.get(address)
+
+    def get(self, marker_id):
+        """
+        Returns the full marker with the id "marker_id", or None if there isn't one.
+        An unknown id may come from another worker process, so the file is re-read if it changed since.
+        """
+        address = self.id_to_address.get(marker_id)
+        if address is None:
+            self._refresh()
+            address = self.id_to_address.get(marker_id)
+        return None if address is None else self.address_to_marker[address]
+
+    def query(self, south, west, north, east):
+        """
+        Returns every marker inside the lat/lng box, including ones other worker processes saved.
+        A box with "west" greater than "east" crosses the antimeridian.
+        """
+        self._refresh()
+        if west > east:
+            return self.query(south, west, north, 180) + self.query(south, -180, north, east)
+
+        min_row, min_col = self._cell(south, west)
+        max_row, max_col = self._cell(north, east)
+        found = []
+        with self.lock:
+            #A zoomed out box spans far more cells than are occupied, then only the occupied ones are looked at.
+            if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self.cell_to_addresses):
+                cells = [cell for cell in self.cell_to_addresses if min_row <= cell[0] <= max_row and min_col <= cell[1] <= max_col]
+            else:
+                cells = [(row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)]
+            for cell in cells:
+                for address in self.cell_to_addresses.get(cell, ()):
+                    marker = self.address_to_marker[address]
+                    lat, lng = marker['geocode']['lat'], marker['geocode']['lng']
+                    #edge cells overlap the box only partially.
+                    if south <= lat <= north and west <= lng <= east:
+                        found.append(marker)
+        logging.debug(f"{len(found)} markers in bounds {south},{west},{north},{east}")
+        return found
+
+    @staticmethod
+    def cluster(markers, zoom, cell_pixels = CLUSTER_CELL_PIXELS):
+        """
+        Groups "markers" that fall in the same "cell_pixels" square of screen at Google Maps zoom level "zoom".
+        Returns the markers left on their own and a list of clusters, each with its key, member count,
+        centroid and the best rating and cashflow among its members.
+        """
+        world_pixels = 256 * 2 ** zoom
+        cell_to_markers = {}
+        for marker in markers:
+            x, y = MarkerIndex._to_pixels(marker['geocode']['lat'], marker['geocode']['lng'], world_pixels)
+            cell = (int(y // cell_pixels), int(x // cell_pixels))
+            cell_to_markers.setdefault(cell, []).append(marker)
+
+        singles = []
+        clusters = []
+        for (row, col), members in cell_to_markers.items():
+            if len(members) == 1:
+                singles.append(members[0])
+                continue
+            clusters.append({
+                'key': f"{zoom}:{row}:{col}",
+                'count': len(members),
+                'lat': sum(member['geocode']['lat'] for member in members) / len(members),
+                'lng': sum(member['geocode']['lng'] for member in members) / len(members),
+                'rating': max(member['rating'] for member in members),
+                'cashflow': max(member['cashflow'] for member in members),
+            })
+        return singles, clusters
+
+    @staticmethod
+    def _to_pixels(lat, lng, world_pixels):
+        """
+        Web Mercator projection of "lat"/"lng" to pixel coordinates on a map "world_pixels" wide, the same one Google Maps uses.
+        """
+        sin_lat = min(max(math.sin(math.radians(lat)), -0.9999), 0.9999)
+        x = (lng + 180) / 360 * world_pixels
+        y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * world_pixels
+        return x, y
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.CELL_DEGREES), math.floor(lng / self.CELL_DEGREES))
+
+    def __len__(self):
+        return len(self.address_to_marker)
@@ -0,0 +1,289 @@
+import json
+import math
+import os
+import datetime
+import threading
+import logging
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from handlers import OnFileLookup
+from safe_files import file_lock, write_json
+
+#Metered upstreams we account for.
+ZILLOW = 'zillow'
+GEOCODE = 'geocode'
+ZIPCODE = 'zipcode'
+UPSTREAMS = [ZILLOW, GEOCODE, ZIPCODE]
+
+PlanStep = namedtuple('PlanStep', ['zip', 'amount', 'listings', 'cost'])
+FetchPlan = namedtuple('FetchPlan', ['steps', 'listings', 'cost'])
+
+
+class QuotaExceeded(Exception):
+    """Raised when a request would go over one of the upstream call budgets."""
+    pass
+
+
+class UsageCounter:
+    """
+    Persisted per-day counts of upstream calls, in total and per user, checked against the configured budgets.
+    Plans are checked up front with check(), and every actual call is refused by record() once a budget is spent,
+    so a bad estimate or concurrent requests can't overrun it.
+    With a "file_name", the counts are shared by every worker process using it: record() re-reads, checks and saves
+    them under a lock on the file, so the budgets hold across processes. Only the last "keep_days" days are kept.
+    """
+    def __init__(self, file_name = None, per_request = None, per_user_day = None, per_day = None, keep_days = 31):
+        self.file_name = file_name
+        self.per_request = per_request #max calls for a single request
+        self.per_user_day = per_user_day #max calls per user per day
+        self.per_day = per_day or {} #max calls per day, by upstream
+        self.keep_days = keep_days
+        self.day_to_counts = {}
+        self.day_to_user_counts = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self._read_file()
+
+    def _read_file(self):
+        """
+        Replaces the counts with the ones saved in "file_name", which include every other process's calls.
+        Keeps the current ones if the file can't be read.
+        """
+        if self.file_name is None or not os.path.exists(self.file_name):
+            return
+        try:
+            with open(self.file_name, 'r') as f:
+                data = json.load(f)
+        except ValueError as e:
+            logging.error(f"keeping the upstream usage we have, {self.file_name} is unreadable: {e}")
+            return
+        self.day_to_counts = data.get('days', {})
+        self.day_to_user_counts = data.get('users', {})
+
+    def _write_file(self):
+        """
+        Saves the counts to "file_name", dropping days older than "keep_days".
+        """
+        oldest = (datetime.datetime.today() - datetime.timedelta(days=self.keep_days)).strftime("%Y%m%d")
+        for day_to_counts in (self.day_to_counts, self.day_to_user_counts):
+            for day in [day for day in day_to_counts if day < oldest]:
+                del day_to_counts[day]
+        write_json(self.file_name, {'days': self.day_to_counts, 'users': self.day_to_user_counts})
+
+    def _file_lock(self):
+        return file_lock(f'{self.file_name}.lock') if self.file_name is not None else nullcontext()
+
+    @staticmethod
+    def _today():
+        return datetime.datetime.today().strftime("%Y%m%d")
+
+    @contextmanager
+    def for_user(self, user):
+        """
+        Attributes every call recorded on this thread to "user" until the block exits, and counts them as one request.
+        """
+        previous = (getattr(self.local, 'user', None), getattr(self.local, 'request_calls', None))
+        self.local.user = user
+        self.local.request_calls = 0
+        try:
+            yield
+        finally:
+            self.local.user, self.local.request_calls = previous
+
+    def record(self, upstream, count = 1):
+        """
+        Counts "count" calls to "upstream" against today, the current user and request, if there are ones.
+        Raises QuotaExceeded instead, counting nothing, if that would go over a budget.
+        """
+        today = self._today()
+        user = getattr(self.local, 'user', None)
+        request_calls = getattr(self.local, 'request_calls', None)
+        with self.lock, self._file_lock():
+            self._read_file()
+            counts = self.day_to_counts.setdefault(today, {})
+            user_counts = self.day_to_user_counts.setdefault(today, {})
+            limit = self.per_day.get(upstream)
+            if limit is not None and counts.get(upstream, 0) + count > limit:
+                raise QuotaExceeded(f"{upstream} has used all {limit} of its calls today")
+            if user is not None and self.per_user_day is not None and user_counts.get(user, 0) + count > self.per_user_day:
+                raise QuotaExceeded(f"user {user} has used all {self.per_user_day} of their upstream calls today")
+            if request_calls is not None and self.per_request is not None and request_calls + count > self.per_request:
+                raise QuotaExceeded(f"request has used all {self.per_request} of its upstream calls")
+
+            counts[upstream] = counts.get(upstream, 0) + count
+            if user is not None:
+                user_counts[user] = user_counts.get(user, 0) + count
+            if request_calls is not None:
+                self.local.request_calls = request_calls + count
+            if self.file_name is not None:
+                self._write_file()
+
+    def check(self, plan, user = None):
+        """
+        Raises QuotaExceeded if running "plan" could go over the per-request, per-user or per-day budgets.
+        """
+        self.check_request(plan)
+        self.check_budgets(plan, user)
+
+    def check_request(self, plan):
+        """
+        Raises QuotaExceeded if "plan" would cost more than a single request may.
+        """
+        total = sum(plan.cost.values())
+        if self.per_request is not None and total > self.per_request:
+            raise QuotaExceeded(f"request would cost ~{total} upstream calls, the limit per request is {self.per_request}")
+
+    def check_budgets(self, plan, user = None):
+        """
+        Raises QuotaExceeded if running "plan" on top of the calls already made today could go over the per-user or per-day budgets.
+        """
+        total = sum(plan.cost.values())
+        today = self._today()
+        with self.lock:
+            self._read_file()
+            counts = dict(self.day_to_counts.get(today, {}))
+            user_spent = self.day_to_user_counts.get(today, {}).get(user, 0)
+
+        if user is not None and self.per_user_day is not None and user_spent + total > self.per_user_day:
+            raise QuotaExceeded(f"user {user} has used {user_spent} of {self.per_user_day} upstream calls today, this request needs ~{total}")
+        for upstream, calls in plan.cost.items():
+            limit = self.per_day.get(upstream)
+            if limit is not None and counts.get(upstream, 0) + calls > limit:
+                raise QuotaExceeded(f"{upstream} has used {counts.get(upstream, 0)} of {limit} calls today, this request needs ~{calls}")
+
+    def snapshot(self):
+        """
+        Returns today's counters and the configured budgets, for ops.
+        """
+        today = self._today()
+        with self.lock:
+            self._read_file()
+            return {
+                'date': today,
+                'calls': dict(self.day_to_counts.get(today, {})),
+                'userCalls': dict(self.day_to_user_counts.get(today, {})),
+                'budgets': {'perRequest': self.per_request, 'perUserDay': self.per_user_day, 'perDay': self.per_day},
+                'history': {day: dict(counts) for day, counts in self.day_to_counts.items()},
+            }
+
+
+class FetchPlanner:
+    """
+    Estimates what a marker request will cost in upstream calls from what is already cached,
+    before anything is fetched, and picks the cheapest set of zips that covers the requested count.
+    """
+    #Rough yields from experience, used to estimate listing fetches.
+    LISTINGS_PER_AGENT_PAGE = 5 #listings in the requested zip per agentActiveListings call
+    AGENTS_PER_PAGE = 10 #zuids returned by one findAgent call
+    #The top-K search scores listings best first and stops once the rest can't beat the k-th best,
+    #so it is budgeted for scoring this many times k listings rather than every one in range.
+    TOP_K_SCORED_FACTOR = 2
+
+    def __init__(self, listing_handler, base_zip_to_near_zips, address_to_geocode, on_file = None):
+        self.listing_handler = listing_handler
+        self.base_zip_to_near_zips = base_zip_to_near_zips
+        self.address_to_geocode = address_to_geocode
+        #what tax and rent is on file, can be shared with the search the plan is for.
+        self.on_file = on_file if on_file is not None else OnFileLookup()
+
+    def _cached_listings(self, zip):
+        return self.listing_handler._hometype_filtered_listings(self.listing_handler.zip_to_listings.get(zip, []))
+
+    def estimate_zip(self, zip, amount, geocode = True):
+        """
+        Returns a PlanStep with the listings and calls by upstream it would take to run get_cashflow_list("zip", "amount"),
+        and to geocode the results unless "geocode" is False.
+        """
+        cached = self._cached_listings(zip)
+        cost = {ZILLOW: 0, GEOCODE: 0}
+        #Every cached listing in the zip gets scored and geocoded, whatever isn't on file costs a call.
+        for listing in cached:
+            cost[ZILLOW] += self._scoring_calls(listing)
+            cost[GEOCODE] += 0 if not geocode or listing.formattedAddress in self.address_to_geocode else 1
+
+        missing = max(0, amount - len(cached))
+        #each new listing then needs its tax, rent and geocode.
+        cost[ZILLOW] += self._listing_calls(missing) + 2 * missing
+        cost[GEOCODE] += missing if geocode else 0
+        return PlanStep(zip, amount, max(amount, len(cached)), cost)
+
+    def plan_top_k(self, zips, k):
+        """
+        Returns a FetchPlan for get_top_cashflow_list("zips", "k") and geocoding its result: fetching up to "k" listings
+        in every zip, scoring at most TOP_K_SCORED_FACTOR * "k" of them, and geocoding the "k" it returns.
+        """
+        steps = []
+        scoring_calls = [] #zillow calls it takes to score each candidate
+        for zip in zips:
+            cached = self._cached_listings(zip)
+            missing = max(0, k - len(cached))
+            steps.append(PlanStep(zip, k, max(k, len(cached)), {ZILLOW: self._listing_calls(missing), GEOCODE: 0}))
+            scoring_calls += [self._scoring_calls(listing) for listing in cached] + [2] * missing
+
+        plan = self.make_plan(steps)
+        #Assume the most expensive candidates are the ones scored.
+        plan.cost[ZILLOW] += sum(sorted(scoring_calls, reverse=True)[:self.TOP_K_SCORED_FACTOR * k])
+        plan.cost[GEOCODE] += k
+        return plan
+
+    def _scoring_calls(self, listing):
+        """
+        Returns how many zillow calls scoring "listing" takes, its tax and rent unless they are on file.
+        """
+        return (0 if self.on_file.tax(listing) is not None else 1) + (0 if self.on_file.rental(listing) is not None else 1)
+
+    def _listing_calls(self, missing):
+        """
+        Returns how many zillow calls fetching "missing" more listings takes.
+        """
+        if missing <= 0:
+            return 0
+        listing_calls = math.ceil(missing / self.LISTINGS_PER_AGENT_PAGE)
+        agent_calls = math.ceil(listing_calls / self.AGENTS_PER_PAGE)
+        return listing_calls + agent_calls
+
+    def plan(self, zip, amount):
+        """
+        Returns the cheapest FetchPlan for "amount" listings around "zip". Compares fetching everything in "zip"
+        against first using the listings already cached in it and its (already known) nearby zips.
+        """
+        base_only = self.make_plan([self.estimate_zip(zip, amount)])
+        if amount <= 0:
+            return base_only
+
+        #Cached listings only, cheapest per listing first.
+        near_zips = self.base_zip_to_near_zips.get(zip, [])
+        cached_steps = []
+        for candidate in [zip] + [near_zip for near_zip in near_zips if near_zip != zip]:
+            count = len(self._cached_listings(candidate))
+            if count > 0:
+                cached_steps.append(self.estimate_zip(candidate, count))
+        cached_steps.sort(key=lambda step: sum(step.cost.values()) / step.listings)
+
+        steps = []
+        found = 0
+        for step in cached_steps:
+            if found >= amount:
+                break
+            steps.append(step)
+            found += step.listings
+        #Still short, so fetch the rest from the base zip.
+        if found < amount:
+            steps = [step for step in steps if step.zip != zip]
+            found = sum(step.listings for step in steps)
+            steps.insert(0, self.estimate_zip(zip, amount - found))
+        cached_first = self.make_plan(steps)
+
+        best = min([base_only, cached_first], key=lambda plan: sum(plan.cost.values()))
+        logging.debug(f"plan for {zip} x{amount}: {best}")
+        return best
+
+    def make_plan(self, steps):
+        """
+        Combines "steps" into one FetchPlan, totalling their listings and cost.
+        """
+        cost = {upstream: 0 for upstream in UPSTREAMS}
+        for step in steps:
+            for upstream, calls in step.cost.items():
+                cost[upstream] += calls
+        return FetchPlan(steps, sum(step.listings for step in steps), cost)
@@ -0,0 +1,56 @@
+import os
+import json
+import uuid
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None #not on Windows, where locks only hold between threads of one process
+
+#One lock per lock file, shared by every thread of this process that takes it.
+_path_to_lock = {}
+_path_locks_lock = threading.Lock()
+
+
+@contextmanager
+def file_lock(lock_path):
+    """
+    Holds "lock_path" exclusively: against other threads with a lock, and against other processes with flock on the file.
+    """
+    with _path_locks_lock:
+        lock = _path_to_lock.setdefault(os.path.realpath(lock_path), threading.Lock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def replacing(path):
+    """
+    Yields a temporary path next to "path" to write the new file to, and moves it over "path" once the block
+    exits without an error, so a reader (or a crash) never sees half a file. Every writer gets its own temporary file.
+    """
+    tmp_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.{uuid.uuid4().hex}.tmp')
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_json(path, data):
+    """
+    Replaces the json file "path" with "data", see replacing().
+    """
+    with replacing(path) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
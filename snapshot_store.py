@@ -0,0 +1,231 @@
+import os
+import re
+import glob
+import datetime
+import logging
+from safe_files import file_lock, replacing
+
+SNAPSHOT_DIRECTORY = 'cashflow_data/snapshots'
+#Every partition is written with these column types (partition columns aside), so the dataset scans as one even where
+#pandas would type a partition's column differently, e.g. int tax in one and float in another, or all-null beds.
+COLUMN_TYPES = {
+    'formattedAddress': 'string',
+    'beds': 'double',
+    'baths': 'double',
+    'price': 'double',
+    'zpid': 'int64',
+    'homeType': 'string',
+    'listingURL': 'string',
+    'rent': 'double',
+    'expenses': 'double',
+    'tax': 'double',
+    'cashflow': 'double',
+}
+#What get_cashflow_list used to write, one file per zip, requested count and day.
+LEGACY_FILE_PATTERN = re.compile(r'(?P<zip>\d{5})_count\d+_(?P<date>\d{8})\.csv$')
+
+
+def _schema(partition_columns = ()):
+    """
+    Returns the pyarrow schema of COLUMN_TYPES, followed by "partition_columns" as strings.
+    """
+    import pyarrow as pa
+
+    return pa.schema([(column, pa.type_for_alias(type_name)) for column, type_name in COLUMN_TYPES.items()] +
+                     [(column, pa.string()) for column in partition_columns])
+
+
+class CashflowSnapshotStore:
+    """
+    Every scored listing frame (as returned by get_cashflow_list), kept as a hive-partitioned columnar dataset:
+    "directory"/date=<YYYY-MM-DD>/zip=<zip>/part.parquet, one row per zpid per day.
+    Queries only open the partitions their date/zip range needs, and push the zpid and column selection down
+    to the parquet row groups instead of loading every file into pandas.
+    Partitions written as part.csv by older versions are still read, and rewritten as parquet when next appended to.
+    """
+    PARTITION_COLUMNS = ['date', 'zip']
+
+    def __init__(self, directory = SNAPSHOT_DIRECTORY):
+        self.directory = directory
+
+    @staticmethod
+    def _date(value):
+        """
+        Returns "value" (a date, datetime, or YYYY-MM-DD/YYYYMMDD string) as the YYYY-MM-DD partition value.
+        """
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return value.strftime('%Y-%m-%d')
+        value = str(value)
+        return f'{value[:4]}-{value[4:6]}-{value[6:]}' if len(value) == 8 else value
+
+    def _partition_dir(self, date, zip):
+        return os.path.join(self.directory, f'date={date}', f'zip={zip}')
+
+    def append(self, cashflow_df, date = None):
+        """
+        Stores the scored listings in "cashflow_df" as of "date" (today by default), partitioned by each listing's zip.
+        A listing scored again on the same day replaces its earlier row. Each partition's read-merge-write is
+        done under its lock, so concurrent appends to the same partition never lose each other's rows.
+        """
+        import pandas as pd
+
+        date = self._date(date or datetime.date.today())
+        for zip, zip_df in cashflow_df.groupby(cashflow_df['zip'].astype(str)):
+            partition_dir = self._partition_dir(date, zip)
+            os.makedirs(partition_dir, exist_ok=True)
+            with file_lock(os.path.join(partition_dir, '.lock')):
+                existing = self._read_partition(partition_dir)
+                merged = zip_df.drop(columns=['zip']) if existing is None else pd.concat([existing, zip_df.drop(columns=['zip'])], ignore_index=True)
+                merged = merged.drop_duplicates(subset='zpid', keep='last').sort_values(by='zpid')
+                self._write_partition(partition_dir, merged)
+
+    def _write_partition(self, partition_dir, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        unknown_columns = [column for column in df.columns if column not in COLUMN_TYPES]
+        if unknown_columns:
+            logging.warning(f"not storing columns {unknown_columns} in {partition_dir}")
+        table = pa.Table.from_pandas(df.reindex(columns=list(COLUMN_TYPES)), schema=_schema(), preserve_index=False)
+        with replacing(os.path.join(partition_dir, 'part.parquet')) as tmp_path:
+            pq.write_table(table, tmp_path)
+        #An older csv partition is in the parquet one now, and must not be read twice.
+        if os.path.exists(os.path.join(partition_dir, 'part.csv')):
+            os.remove(os.path.join(partition_dir, 'part.csv'))
+
+    @staticmethod
+    def _read_partition(partition_dir, columns = None):
+        import pandas as pd
+
+        if os.path.exists(os.path.join(partition_dir, 'part.parquet')):
+            return pd.read_parquet(os.path.join(partition_dir, 'part.parquet'), columns=columns)
+        if os.path.exists(os.path.join(partition_dir, 'part.csv')):
+            return pd.read_csv(os.path.join(partition_dir, 'part.csv'), usecols=columns)
+        return None
+
+    def _partitions(self, start = None, end = None, zips = None):
+        """
+        Returns the (date, zip, directory) of every partition between the dates "start" and "end" (inclusive)
+        and in "zips", oldest first. This is the partition pruning, no data file is opened.
+        """
+        start = self._date(start) if start is not None else None
+        end = self._date(end) if end is not None else None
+        zips = {str(zip) for zip in zips} if zips is not None else None
+        partitions = []
+        for partition_dir in glob.glob(os.path.join(self.directory, 'date=*', 'zip=*')):
+            date = os.path.basename(os.path.dirname(partition_dir))[len('date='):]
+            zip = os.path.basename(partition_dir)[len('zip='):]
+            if (start is not None and date < start) or (end is not None and date > end) or (zips is not None and zip not in zips):
+                continue
+            partitions.append((date, zip, partition_dir))
+        return sorted(partitions)
+
+    def query(self, columns = None, zpids = None, zips = None, start = None, end = None):
+        """
+        Returns the stored rows between the dates "start" and "end" (inclusive), optionally only for "zpids" and "zips",
+        with only "columns" plus the date and zip they were stored under, sorted by date and zpid.
+        """
+        import pandas as pd
+
+        read_columns = None if columns is None else list(dict.fromkeys(['zpid'] + [column for column in columns if column not in self.PARTITION_COLUMNS]))
+        partitions = self._partitions(start, end, zips)
+        parquet_partitions = [partition for partition in partitions if os.path.exists(os.path.join(partition[2], 'part.parquet'))]
+        frames = []
+
+        if parquet_partitions:
+            import pyarrow as pa
+            import pyarrow.dataset as ds
+
+            partitioning = ds.partitioning(pa.schema([(column, pa.string()) for column in self.PARTITION_COLUMNS]), flavor='hive')
+            #Read with the fixed schema, so partitions written before it was fixed are cast to it.
+            parquet_dataset = ds.dataset([os.path.join(partition[2], 'part.parquet') for partition in parquet_partitions], schema=_schema(self.PARTITION_COLUMNS),
+                                         format='parquet', partitioning=partitioning, partition_base_dir=self.directory)
+            row_filter = ds.field('zpid').isin([int(zpid) for zpid in zpids]) if zpids is not None else None
+            table = parquet_dataset.to_table(columns=None if read_columns is None else read_columns + self.PARTITION_COLUMNS, filter=row_filter)
+            frames.append(table.to_pandas())
+
+        #Partitions written as csv by older versions.
+        for date, zip, partition_dir in partitions:
+            if (date, zip, partition_dir) in parquet_partitions:
+                continue
+            df = self._read_partition(partition_dir, read_columns)
+            if df is None:
+                continue
+            if zpids is not None:
+                df = df[df['zpid'].isin([int(zpid) for zpid in zpids])]
+            frames.append(df.assign(date=date, zip=zip))
+
+        output_columns = (read_columns if read_columns is not None else [column for frame in frames[:1] for column in frame.columns if column not in self.PARTITION_COLUMNS]) + self.PARTITION_COLUMNS
+        if not frames:
+            return pd.DataFrame(columns=output_columns)
+        result = pd.concat(frames, ignore_index=True)
+        result['zip'] = result['zip'].astype(str)
+        return result[output_columns].sort_values(by=['date', 'zpid'], ignore_index=True)
+
+    def zpid_trend(self, zpid, start = None, end = None):
+        """
+        Returns the price, rent, expenses, tax and cashflow of "zpid" on every day it was scored.
+        """
+        return self.query(['zpid', 'price', 'rent', 'expenses', 'tax', 'cashflow'], zpids=[zpid], start=start, end=end)
+
+    def zip_trend(self, zip, start = None, end = None):
+        """
+        Returns, for every day "zip" was scored, how many listings were scored, how many cashflowed,
+        and their median and mean cashflow.
+        """
+        import pandas as pd
+
+        df = self.query(['zpid', 'cashflow'], zips=[zip], start=start, end=end)
+        if df.empty:
+            return pd.DataFrame(columns=['date', 'listings', 'positive', 'medianCashflow', 'meanCashflow'])
+        grouped = df.groupby('date')['cashflow']
+        return pd.DataFrame({
+            'listings': grouped.size(),
+            'positive': grouped.apply(lambda cashflow: int((cashflow > 0).sum())),
+            'medianCashflow': grouped.median(),
+            'meanCashflow': grouped.mean(),
+        }).reset_index()
+
+    def turned_positive(self, since, zips = None):
+        """
+        Returns the listings whose latest cashflow is positive but whose last cashflow on or before the date "since" wasn't,
+        with both cashflows and the dates they were scored on.
+        """
+        since = self._date(since)
+        columns = ['zpid', 'formattedAddress', 'listingURL', 'cashflow']
+        before = self.query(columns, zips=zips, end=since).drop_duplicates(subset='zpid', keep='last')
+        before = before[before['cashflow'] <= 0]
+        if before.empty:
+            return before.assign(cashflowBefore=[], dateBefore=[])
+
+        #Only listings that weren't cashflowing then can qualify, so only those are read back.
+        day_after = (datetime.datetime.strptime(since, '%Y-%m-%d') + datetime.timedelta(days=1)).date()
+        after = self.query(columns, zpids=list(before['zpid']), zips=zips, start=day_after).drop_duplicates(subset='zpid', keep='last')
+        after = after[after['cashflow'] > 0]
+
+        turned = after.merge(before[['zpid', 'cashflow', 'date']], on='zpid', suffixes=('', 'Before'))
+        return turned.sort_values(by='cashflow', ascending=False, ignore_index=True)
+
+    def import_legacy_files(self, directory = 'cashflow_data'):
+        """
+        Loads the old per-request {zip}_count{n}_{date}.csv files in "directory" into the store, oldest first.
+        Returns how many were imported. The files themselves are left alone.
+        """
+        import pandas as pd
+
+        legacy_files = []
+        for file_name in os.listdir(directory) if os.path.isdir(directory) else []:
+            match = LEGACY_FILE_PATTERN.match(file_name)
+            if match:
+                legacy_files.append((match.group('date'), file_name))
+        for date, file_name in sorted(legacy_files):
+            try:
+                self.append(pd.read_csv(os.path.join(directory, file_name), dtype={'zip': str}), date)
+            except (KeyError, ValueError) as e:
+                logging.warning(f"skipping {file_name}: {e}")
+        return len(legacy_files)
+
+
+if __name__ == "__main__":
+    #One-off migration of the old snapshot files.
+    print(f"imported {CashflowSnapshotStore().import_legacy_files()} files")
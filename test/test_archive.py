@@ -0,0 +1,102 @@
+import datetime
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from archive import KEYS_SUFFIX, ResponseArchive
+from handlers import RentalHandler
+
+RENTAL_RESP = {'comparableRentals': 1, 'percentile_25': 1999, 'highRent': 1999, 'lowRent': 1999, 'lat': 40.638317,
+               'median': 1999, 'rent': 1999, 'percentile_75': 1999, 'long': -73.594849}
+
+class TestResponseArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archive = ResponseArchive(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_append_and_latest(self):
+        query = {"propertyType": "Condo", "address": "1 Main St", "d": "0.5"}
+        self.archive.append("rentEstimate", query, RENTAL_RESP)
+        self.archive.append("rentEstimate", dict(reversed(list(query.items()))), {**RENTAL_RESP, 'median': 2100})
+
+        self.assertEqual(self.archive.endpoints(), ["rentEstimate"])
+        self.assertEqual(len(list(self.archive.records("rentEstimate"))), 2)
+        self.assertEqual(self.archive.latest("rentEstimate", query)['response']['median'], 2100)
+        self.assertIsNone(self.archive.latest("rentEstimate", {"address": "2 Main St"}))
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        self.assertEqual(list(self.archive.records("rentEstimate", since=tomorrow)), [])
+
+    def test_secrets_are_not_archived(self):
+        self.archive.append("geocode", {"address": "1 Main St", "key": "secret"}, {'results': []})
+        record = next(self.archive.records("geocode"))
+        self.assertEqual(record['query'], {"address": "1 Main St"})
+        self.assertIsNotNone(self.archive.latest("geocode", {"address": "1 Main St", "key": "other"}))
+
+    def test_replay_reruns_processor_offline(self):
+        self.archive.append("rentEstimate", {"address": "1 Main St"}, RENTAL_RESP)
+        self.archive.append("rentEstimate", {"address": "2 Main St"}, {'broken': True})
+        #A field the original processor threw away.
+        results = self.archive.replay("rentEstimate", lambda resp, query: (query['address'], resp['lat'], resp['long']))
+        self.assertEqual([result for _, result in results], [("1 Main St", 40.638317, -73.594849)])
+
+        rental_filename = f"{self.directory.name}/rental.json"
+        results = self.archive.replay("rentEstimate", lambda resp, query: RentalHandler._process_rental_api_resp(resp, rental_filename))
+        self.assertEqual(results[0][1].median, 1999)
+
+    def test_latest_reads_only_the_record_it_returns(self):
+        for i in range(20):
+            self.archive.append("rentEstimate", {"address": f"{i} Main St"}, {**RENTAL_RESP, 'median': i})
+        self.archive.append("rentEstimate", {"address": "3 Main St"}, {**RENTAL_RESP, 'median': 2100})
+
+        with patch("archive.gzip.open") as mock_gzip_open:
+            self.assertEqual(self.archive.latest("rentEstimate", {"address": "3 Main St"})['response']['median'], 2100)
+            results = self.archive.replay("rentEstimate", lambda resp, query: resp['median'])
+        mock_gzip_open.assert_not_called()
+        self.assertEqual(len(results), 20)
+        self.assertIn(2100, [result for _, result in results])
+
+        #A second archive, e.g. in another worker, sees what this one appends after it built its index.
+        other = ResponseArchive(self.directory.name)
+        other.latest("rentEstimate", {"address": "1 Main St"})
+        self.archive.append("rentEstimate", {"address": "1 Main St"}, {**RENTAL_RESP, 'median': 3000})
+        self.assertEqual(other.latest("rentEstimate", {"address": "1 Main St"})['response']['median'], 3000)
+
+    def test_index_is_rebuilt_for_old_archives(self):
+        self.archive.append("geocode", {"address": "1 Main St"}, {'results': [1]})
+        self.archive.append("geocode", {"address": "1 Main St"}, {'results': [2]})
+        #Archived before sidecars were kept.
+        for name in os.listdir(os.path.join(self.directory.name, "geocode")):
+            if name.endswith(KEYS_SUFFIX):
+                os.remove(os.path.join(self.directory.name, "geocode", name))
+
+        archive = ResponseArchive(self.directory.name)
+        self.assertEqual(archive.latest("geocode", {"address": "1 Main St"})['response'], {'results': [2]})
+        archive.append("geocode", {"address": "2 Main St"}, {'results': [3]})
+        self.assertEqual(len(list(archive.records("geocode"))), 3)
+        self.assertEqual(ResponseArchive(self.directory.name).latest("geocode", {"address": "2 Main St"})['response'], {'results': [3]})
+
+    def test_replay_survives_a_wrong_index(self):
+        for i in range(3):
+            self.archive.append("rentEstimate", {"address": f"{i} Main St"}, {**RENTAL_RESP, 'median': i})
+        endpoint_dir = os.path.join(self.directory.name, "rentEstimate")
+        sidecar = os.path.join(endpoint_dir, next(name for name in os.listdir(endpoint_dir) if name.endswith(KEYS_SUFFIX)))
+        with open(sidecar, 'r') as f:
+            entries = [json.loads(line) for line in f]
+        #One offset in the middle of a record, one pointing at another query's record.
+        entries[1]['offset'] += 5
+        entries[2]['offset'] = entries[0]['offset']
+        with open(sidecar, 'w') as f:
+            f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+
+        archive = ResponseArchive(self.directory.name)
+        results = archive.replay("rentEstimate", lambda resp, query: (query['address'], resp['median']))
+        self.assertEqual(sorted(result for _, result in results), [("0 Main St", 0), ("1 Main St", 1), ("2 Main St", 2)])
+        self.assertEqual(archive.latest("rentEstimate", {"address": "2 Main St"})['response']['median'], 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+from gmaps_converter import GeocodeCache, GmapsInterlinker, create_app, _keal_estate, _user
+
+ZIP_RESP = {'zip_codes': [{'zip_code': '11563', 'distance': 0}, {'zip_code': '11570', 'distance': 0.8},
+                          {'zip_code': '11550', 'distance': 2.5}, {'zip_code': '11530', 'distance': 12.1}]}
+
+class TestNearZips(unittest.TestCase):
+
+    def setUp(self):
+        #GmapsInterlinker keeps its caches in the working directory.
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    @patch("gmaps_converter.get_controller")
+    def test_radius_is_respected_and_cached(self, mock_get_controller):
+        mock_get_controller.return_value.get.return_value = MagicMock(status_code=200, json=MagicMock(return_value=ZIP_RESP))
+        interlinker = GmapsInterlinker({'ZIPCODE_KEY': 'test'})
+
+        self.assertEqual(interlinker._get_near_zips('11563', 15), ['11570', '11550', '11530'])
+        #Narrower radii are answered from the wider search, and the nearby fallback isn't widened by it.
+        self.assertEqual(interlinker._get_near_zips('11563', 1), ['11570'])
+        self.assertEqual(GmapsInterlinker({'ZIPCODE_KEY': 'test'})._get_near_zips('11563', 5), ['11570', '11550'])
+        self.assertEqual(interlinker.base_zip_to_near_zips['11563'], ['11570', '11550'])
+        self.assertEqual(mock_get_controller.return_value.get.call_count, 1)
+
+        #A wider radius than was searched needs a new call.
+        interlinker._get_near_zips('11563', 50)
+        self.assertEqual(mock_get_controller.return_value.get.call_count, 2)
+
+    @patch("gmaps_converter.get_controller")
+    def test_caches_are_kept_in_the_given_files(self, mock_get_controller):
+        mock_get_controller.return_value.get.return_value = MagicMock(status_code=200, json=MagicMock(return_value=ZIP_RESP))
+        os.mkdir("cache")
+        files = {'near_zips_file': "cache/near.json", 'near_zip_distances_file': "cache/distances.json"}
+        GmapsInterlinker({'ZIPCODE_KEY': 'test'}, **files)._get_near_zips('11563', 15)
+
+        self.assertEqual(sorted(os.listdir("cache")), ["distances.json", "near.json"])
+        self.assertEqual(os.listdir('.'), ["cache"])
+        self.assertEqual(GmapsInterlinker({'ZIPCODE_KEY': 'test'}, **files)._get_near_zips('11563', 5), ['11570', '11550'])
+        self.assertEqual(mock_get_controller.return_value.get.call_count, 1)
+
+class TestGeocodeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    @patch("gmaps_converter.get_controller")
+    def test_geocodes_are_shared_and_kept(self, mock_get_controller):
+        location = {'results': [{'geometry': {'location': {'lat': 40.7, 'lng': -73.6}}}]}
+        mock_get_controller.return_value.get.return_value = MagicMock(status_code=200, json=MagicMock(return_value=location))
+        geocodes = GeocodeCache()
+        first, second = GmapsInterlinker({'GMAPS_KEY': 'test'}, geocodes=geocodes), GmapsInterlinker({'GMAPS_KEY': 'test'}, geocodes=geocodes)
+
+        first._cached_geocode("1 Main St")
+        second._cached_geocode("1 Main St")
+        second._cached_geocode("2 Main St")
+        #Saving from the interlinker that was created first doesn't lose the other's geocodes.
+        first.geocodes.save()
+        self.assertEqual(mock_get_controller.return_value.get.call_count, 2)
+        self.assertEqual(sorted(GeocodeCache().address_to_geocode), ["1 Main St", "2 Main St"])
+        self.assertEqual(sorted(os.listdir('.')), ["geocodes.json", "geocodes.json.lock"])
+
+    @patch("gmaps_converter.get_controller")
+    def test_workers_keep_and_reuse_each_others_geocodes(self, mock_get_controller):
+        location = {'results': [{'geometry': {'location': {'lat': 40.7, 'lng': -73.6}}}]}
+        mock_get_controller.return_value.get.return_value = MagicMock(status_code=200, json=MagicMock(return_value=location))
+        worker_a, worker_b = GmapsInterlinker({'GMAPS_KEY': 'test'}, geocodes=GeocodeCache()), GmapsInterlinker({'GMAPS_KEY': 'test'}, geocodes=GeocodeCache())
+
+        worker_a._cached_geocode("1 Main St")
+        worker_a.geocodes.save()
+        worker_b._cached_geocode("2 Main St")
+        worker_b.geocodes.save()
+        self.assertEqual(sorted(GeocodeCache().address_to_geocode), ["1 Main St", "2 Main St"])
+        #Bought by worker a, so worker b doesn't buy it again.
+        worker_b._cached_geocode("1 Main St")
+        self.assertEqual(mock_get_controller.return_value.get.call_count, 2)
+
+class TestScenarioGridArguments(unittest.TestCase):
+
+    def setUp(self):
+        app = create_app({'API_KEYS': {'GMAPS_KEY': 'test', 'ZILLOW_KEY': 'test', 'ZIPCODE_KEY': 'test'}, 'MARKER_INDEX_FILE': 'no_such_index.json',
+                          'USAGE_FILE': None, 'LISTING_COMPACTION_SECONDS': None})
+        self.client = app.test_client()
+
+    def test_bad_axes_are_rejected(self):
+        for query in ['interestRates=abc', 'interestRates=1:5:0', 'interestRates=5:1:1', 'interestRates=1:5', 'interestRates=nan',
+                      'interestRates=0:100:0.00001', 'interestRates=0:9.9:0.1&downPayments=0:0.9:0.1&loanYears=10:40:1',
+                      'loanYears=0', 'loanYears=-30', 'loanYears=10:1000:100', 'downPayments=1.5', 'downPayments=-0.1', 'interestRates=-50',
+                      'interestRates=1e6', 'expenseRatios=1', 'expenseRatios=-0.2']:
+            response = self.client.get(f'/scenario-grid/11111/5?{query}')
+            self.assertEqual(response.status_code, 400, query)
+            self.assertIn('error', response.get_json())
+
+class TestQuotaIdentity(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {'API_KEYS': {'GMAPS_KEY': 'test', 'ZILLOW_KEY': 'test', 'ZIPCODE_KEY': 'test'}, 'MARKER_INDEX_FILE': 'no_such_index.json',
+                       'USAGE_FILE': None, 'LISTING_COMPACTION_SECONDS': None}
+
+    def test_calls_are_charged_to_the_client_address(self):
+        app = create_app(self.config)
+        with app.test_request_context('/', headers={'X-User-Id': 'someone-else'}, environ_base={'REMOTE_ADDR': '203.0.113.7'}):
+            self.assertEqual(_user(), '203.0.113.7')
+
+    def test_ops_needs_the_token_or_a_local_request(self):
+        client = create_app(self.config).test_client()
+        self.assertEqual(client.get('/ops/quota').status_code, 200)
+        self.assertEqual(client.get('/ops/quota', environ_base={'REMOTE_ADDR': '203.0.113.7'}).status_code, 403)
+
+        client = create_app({**self.config, 'OPS_TOKEN': 'secret'}).test_client()
+        for path in ['/ops/quota', '/ops/upstreams']:
+            self.assertEqual(client.get(path).status_code, 403)
+            self.assertEqual(client.get(path, headers={'Authorization': 'Bearer wrong'}).status_code, 403)
+            self.assertEqual(client.get(path, headers={'Authorization': 'Bearer secret'}, environ_base={'REMOTE_ADDR': '203.0.113.7'}).status_code, 200)
+
+class TestAppConfig(unittest.TestCase):
+
+    def test_apps_keep_their_own_settings(self):
+        with tempfile.TemporaryDirectory() as directory:
+            apps = []
+            for name in ["a", "b"]:
+                apps.append(create_app({'API_KEYS': {'GMAPS_KEY': name, 'ZILLOW_KEY': name, 'ZIPCODE_KEY': name}, 'MARKER_INDEX_FILE': 'no_such_index.json',
+                                        'USAGE_FILE': None, 'LISTING_COMPACTION_SECONDS': None, 'LISTING_DIR': os.path.join(directory, name, "listings"),
+                                        'TAX_DIR': os.path.join(directory, name, "tax"), 'RENTAL_DIR': os.path.join(directory, name, "rental")}))
+
+            for name, app in zip(["a", "b"], apps):
+                with app.test_request_context('/'):
+                    keal_estate = _keal_estate([])
+                self.assertEqual(keal_estate.listing_handler.zillow.api_keys['ZILLOW_KEY'], name)
+                self.assertIs(keal_estate.tax_handler.zillow, app.extensions['zillow'])
+                self.assertEqual(keal_estate.listing_handler.store.directory, os.path.join(directory, name, "listings"))
+                self.assertEqual(keal_estate.tax_handler.directory, os.path.join(directory, name, "tax"))
+                self.assertEqual(keal_estate.rental_handler.directory, os.path.join(directory, name, "rental"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,9 @@
+import json
+import os
+import tempfile
 import unittest
 from unittest.mock import patch
-from handlers import ListingsHandler
+from handlers import ListingData, ListingsHandler, OnFileLookup, RentalData
 
 """
 RENTAL RESP
@@ -45,3 +48,24 @@ class TestListingsHandler(unittest.TestCase):
         # Check that the result is what you expect
         expected_result = "expected result"  # Replace with the expected output
         self.assertEqual(result, expected_result)
+
+class TestOnFileLookup(unittest.TestCase):
+
+    def test_reads_each_directory_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            tax_directory, rental_directory = os.path.join(directory, "tax_data"), os.path.join(directory, "rental_data")
+            os.makedirs(tax_directory)
+            os.makedirs(rental_directory)
+            with open(os.path.join(tax_directory, "1 Main St_tax_20240101.json"), 'w') as f:
+                json.dump({'tax': 3000}, f)
+            with open(os.path.join(rental_directory, "1 Main St_rental_20240101.json"), 'w') as f:
+                json.dump(RentalData(1500, 1400, None, 1450, 1550, 3)._asdict(), f)
+            listings = [ListingData(f"{i} Main St", "11111", 3, 2, 200000, i, "singleFamily", "/main") for i in range(1, 4)]
+
+            with patch("handlers.glob.glob") as mock_glob:
+                on_file = OnFileLookup(tax_directory, rental_directory)
+                for _ in range(2):
+                    self.assertEqual([on_file.tax(listing) for listing in listings], [3000, None, None])
+                    self.assertEqual([on_file.rental(listing) for listing in listings], [RentalData(1500, 1400, 0, 1450, 1550, 3), None, None])
+            mock_glob.assert_not_called()
+
@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+#Budget for a fresh interpreter to import the whole app, keeps worker spawn and cold starts fast.
+IMPORT_BUDGET_SECONDS = 1.5
+HEAVY_MODULES = ['pandas', 'numpy', 'requests']
+
+class TestImportTime(unittest.TestCase):
+
+    def _run_fresh(self, code):
+        #Run from an empty directory so nothing can depend on api_keys.json or other data files existing.
+        with tempfile.TemporaryDirectory() as empty_dir:
+            env = dict(os.environ, PYTHONPATH=REPO_DIR)
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, '-c', code], cwd=empty_dir, env=env, capture_output=True, text=True)
+            elapsed = time.perf_counter() - start
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return result.stdout, elapsed
+
+    def test_import_has_no_heavy_imports_or_side_effects(self):
+        stdout, _ = self._run_fresh(
+            "import logging, sys\n"
+            "import handlers, keal_estate, gmaps_converter\n"
+            f"print([name for name in {HEAVY_MODULES!r} if name in sys.modules])\n"
+            "print(logging.getLogger().handlers)\n")
+        self.assertEqual(stdout.splitlines(), ['[]', '[]'])
+
+    def test_import_within_budget(self):
+        _, elapsed = self._run_fresh("import gmaps_converter")
+        self.assertLess(elapsed, IMPORT_BUDGET_SECONDS)
+
+if __name__ == "__main__":
+    unittest.main()
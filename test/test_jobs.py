@@ -0,0 +1,108 @@
+import threading
+import unittest
+from unittest.mock import patch
+from jobs import Job, JobManager, JobQueueFull
+from gmaps_converter import create_app
+
+def wait_for(job):
+    #Jobs run on the pool, wait until this one has finished.
+    while job.status not in Job.FINISHED:
+        job.cancel_requested.wait(0.01)
+    return job
+
+class TestJobManager(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = JobManager(max_workers=1, max_queued=1)
+
+    def tearDown(self):
+        self.manager.shutdown()
+
+    def test_progress_partial_results_and_reuse(self):
+        def work(job, count):
+            for i in range(count):
+                job.report(partial=list(range(i + 1)), done=i + 1, total=count)
+            return 'result'
+
+        job, reused = self.manager.submit('key', work, 3)
+        self.assertFalse(reused)
+        wait_for(job)
+        self.assertEqual(job.snapshot(), {'id': job.id, 'status': Job.DONE, 'progress': {'done': 3, 'total': 3}, 'error': None, 'results': 'result'})
+
+        #The identical job gets the finished one back instead of running again.
+        self.assertEqual(self.manager.submit('key', work, 3), (job, True))
+        self.assertIs(self.manager.find('key'), job)
+        self.assertIsNone(self.manager.find('other key'))
+
+    def test_cancel_running_and_queued_jobs(self):
+        started = threading.Event()
+        def work(job):
+            started.set()
+            while True:
+                job.report(partial=['found'])
+                job.cancel_requested.wait(0.01)
+
+        running, _ = self.manager.submit('running', work)
+        started.wait(5)
+        queued, _ = self.manager.submit('queued', work)
+        self.assertEqual(queued.status, Job.QUEUED)
+        #One worker busy, one job waiting, so there is no room for another.
+        with self.assertRaises(JobQueueFull):
+            self.manager.submit('refused', work)
+
+        self.assertIs(self.manager.cancel(queued.id), queued)
+        self.assertEqual(queued.status, Job.CANCELLED)
+        self.manager.cancel(running.id)
+        self.assertEqual(wait_for(running).status, Job.CANCELLED)
+        self.assertEqual(running.snapshot()['results'], ['found'])
+        self.assertIsNone(self.manager.cancel('no such job'))
+
+        #Cancelled jobs are not reused.
+        job, reused = self.manager.submit('running', lambda job: 'again')
+        self.assertFalse(reused)
+        self.assertEqual(wait_for(job).result, 'again')
+
+    def test_failed_job_keeps_error(self):
+        def work(job):
+            raise ValueError('upstream broke')
+
+        job, _ = self.manager.submit('key', work)
+        self.assertEqual(wait_for(job).snapshot()['error'], 'upstream broke')
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIsNone(self.manager.find('key'))
+
+class TestJobRoutes(unittest.TestCase):
+
+    def setUp(self):
+        app = create_app({'API_KEYS': {'GMAPS_KEY': 'test', 'ZILLOW_KEY': 'test', 'ZIPCODE_KEY': 'test'}, 'MARKER_INDEX_FILE': 'no_such_index.json', 'USAGE_FILE': None, 'LISTING_COMPACTION_SECONDS': None})
+        self.jobs = app.extensions['jobs']
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.jobs.shutdown()
+
+    def test_submit_poll_and_reuse(self):
+        markers = [{'address': '1 Main St', 'geocode': {'lat': 40.0, 'lng': -73.0}, 'rating': 1, 'cashflow': 250.0, 'listingURL': '/1'}]
+        with patch("gmaps_converter._plan_search") as mock_plan_search, patch("gmaps_converter._search_markers", return_value=markers) as mock_search_markers:
+            response = self.client.post('/jobs', json={'zip': '11111', 'amount': 5})
+            self.assertEqual(response.status_code, 202)
+            job_id = response.get_json()['id']
+            self.assertEqual(response.headers['Location'], f'/jobs/{job_id}')
+            wait_for(self.jobs.get(job_id))
+
+            result = self.client.get(f'/jobs/{job_id}').get_json()
+            self.assertEqual((result['status'], result['results']), (Job.DONE, markers))
+            self.assertEqual(mock_search_markers.call_args.args[:2], ('11111', 5))
+
+            #Same search again, not re-planned or re-run.
+            response = self.client.post('/jobs', json={'zip': '11111', 'amount': 5, 'excludedHomeTypes': []})
+            self.assertEqual((response.status_code, response.get_json()['id']), (200, job_id))
+            self.assertEqual(mock_plan_search.call_count, 1)
+
+        self.assertEqual(self.client.post('/jobs', json={'zip': '111', 'amount': 5}).status_code, 400)
+        self.assertEqual(self.client.post('/jobs', json={'zip': '11111', 'amount': 5, 'excludedHomeTypes': [1, None]}).status_code, 400)
+        self.assertEqual(self.client.get('/jobs/nope').status_code, 404)
+        self.assertEqual(self.client.delete('/jobs/nope').status_code, 404)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,17 @@
 import unittest
-from keal_estate import app
+from unittest.mock import MagicMock, patch
+import numpy as np
+import pandas as pd
+from keal_estate import KealEstate
+from gmaps_converter import create_app
+from handlers import ListingData, RentalData
 
 class FlaskTestCase(unittest.TestCase):
 
     def setUp(self):
         # Create a test client
+        app = create_app({'API_KEYS': {'GMAPS_KEY': 'test', 'ZILLOW_KEY': 'test', 'ZIPCODE_KEY': 'test'}, 'MARKER_INDEX_FILE': 'no_such_index.json',
+                          'USAGE_FILE': None, 'LISTING_COMPACTION_SECONDS': None})
         self.app = app.test_client()
         self.app.testing = True 
 
@@ -22,5 +29,77 @@ class FlaskTestCase(unittest.TestCase):
         # Assert that the response data matches
         self.assertEqual(result.data, b'Expected data')
 
+class TestTopCashflowList(unittest.TestCase):
+
+    @patch("keal_estate.TaxHandler")
+    @patch("keal_estate.RentalHandler")
+    @patch("keal_estate.ListingsHandler")
+    def test_top_k_prunes_expensive_listings(self, mock_listings_handler, mock_rental_handler, mock_tax_handler):
+        cheap = [ListingData(f"{i} Cheap St", "11111", 3, 2, 100000 + i, i, "singleFamily", "/cheap") for i in range(3)]
+        expensive = ListingData("1 Mansion Ln", "22222", 6, 5, 5000000, 99, "singleFamily", "/mansion")
+        zip_to_listings = {"11111": cheap, "22222": [expensive]}
+        mock_listings_handler.return_value.get_listings.side_effect = lambda zip, amount: zip_to_listings[zip]
+
+        #Nothing on file yet, every listing rents for 1200 and pays 3000/yr in tax.
+        on_file = MagicMock()
+        on_file.rental.return_value = None
+        on_file.tax.return_value = None
+        mock_rental_handler.return_value.get_rental_data.return_value = RentalData(1200, 1100, 1300, 1150, 1250, 5)
+        mock_tax_handler.return_value.get_tax_data.return_value = 3000
+
+        df = KealEstate().get_top_cashflow_list(["11111", "22222"], 2, on_file=on_file)
+
+        self.assertEqual(list(df['zpid']), [0, 1])
+        self.assertTrue(df['cashflow'].is_monotonic_decreasing)
+        #The mansion's mortgage alone rules it out, so its tax/rent is never fetched.
+        scored = [call.args[0] for call in mock_rental_handler.return_value.get_rental_data.call_args_list]
+        self.assertCountEqual(scored, cheap)
+
+        with self.assertRaises(ValueError):
+            KealEstate().get_top_cashflow_list(["11111"], 0)
+
+    @patch("keal_estate.ListingsHandler")
+    def test_rent_ceiling_follows_zip_rents(self, mock_listings_handler):
+        listings = [ListingData(f"{i} Main St", "11111", 3, 2, 200000, i, "singleFamily", "/main") for i in range(4)]
+        keal_estate = KealEstate()
+        on_file = MagicMock()
+        #Too few rents on file, so the default ratio is used.
+        on_file.rental.side_effect = lambda listing: RentalData(1600, 0, 0, 0, 0, 0) if listing.zpid < 2 else None
+        self.assertEqual(keal_estate._rent_to_price_ceiling(listings, on_file), KealEstate.DEFAULT_RENT_TO_PRICE)
+
+        on_file.rental.side_effect = lambda listing: RentalData(1600, 0, 0, 0, 0, 0) if listing.zpid < 3 else None
+        rent_to_price = keal_estate._rent_to_price_ceiling(listings, on_file)
+        self.assertAlmostEqual(rent_to_price, .008 * KealEstate.RENT_TO_PRICE_MARGIN)
+        self.assertAlmostEqual(keal_estate._rent_ceiling(listings[3], rent_to_price), 2000)
+        mansion = listings[3]._replace(price=5000000)
+        self.assertEqual(keal_estate._rent_ceiling(mansion, rent_to_price), KealEstate.PLAUSIBLE_RENT_CEILING)
+
+class TestScenarioGrid(unittest.TestCase):
+
+    @patch("keal_estate.ListingsHandler")
+    def test_grid_matches_point_estimate_and_break_even(self, mock_listings_handler):
+        keal_estate = KealEstate()
+        listings = [ListingData("1 Main St", "11111", 3, 2, 300000, 1, "singleFamily", "/1"),
+                    ListingData("2 Main St", "11111", 3, 2, 150000, 2, "singleFamily", "/2")]
+        rental = RentalData(2500, 2000, 3000, 2200, 2800, 5)
+        df = pd.DataFrame([{**listing._asdict(), 'rent': rental.median, 'tax': 4000} for listing in listings])
+
+        expense_ratio = KealEstate.VACANCY_RATE + KealEstate.REPAIRS_RATE + KealEstate.MGMT_RATE
+        cashflow, break_even = keal_estate.calculate_scenario_grid(df, [0, 5, KealEstate.INTEREST_RATE], [.1, KealEstate.DOWN_PAYMENT], [15, 30], [expense_ratio])
+
+        self.assertEqual(cashflow.shape, (2, 3, 2, 2, 1))
+        self.assertEqual(break_even.shape, (2, 2, 2, 1))
+        #The default scenario must agree with the single point cashflow.
+        for i, listing in enumerate(listings):
+            expected = rental.median - keal_estate.calculate_expenses(listing, 4000, rental)
+            self.assertAlmostEqual(cashflow[i, 2, 1, 1, 0], expected, places=6)
+
+        #At its break-even rate a listing cashflows zero.
+        rate = break_even[1, 1, 1, 0]
+        at_break_even, _ = keal_estate.calculate_scenario_grid(df.iloc[[1]], [rate], [KealEstate.DOWN_PAYMENT], [30], [expense_ratio])
+        self.assertAlmostEqual(at_break_even[0, 0, 0, 0, 0], 0, places=4)
+        #The pricier listing on a 15 year loan with 10% down can't cashflow even at 0%.
+        self.assertTrue(np.isnan(break_even[0, 0, 0, 0]))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+import pandas as pd
+from handlers import ListingData
+from listing_store import ListingStore
+
+def make_listing(zpid, price, zip = "11111"):
+    return ListingData(f"{zpid} Main St", zip, 3, 2, price, zpid, "singleFamily", f"/{zpid}")
+
+class TestListingStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_only_changes_are_logged(self):
+        store = ListingStore(self.path)
+        self.assertEqual(store.append_batch([make_listing(1, 100000), make_listing(2, 200000)], ['active', 'active']), 2)
+        self.assertEqual(store.append_batch([make_listing(1, 100000), make_listing(2, 190000)], ['active', 'active']), 1)
+        self.assertEqual(store.append_batch([make_listing(1, 100000)], ['pending']), 1)
+
+        #A fresh reader sees the current row of each zpid.
+        reloaded = ListingStore(self.path)
+        self.assertEqual(sorted(reloaded.listings()), [make_listing(1, 100000), make_listing(2, 190000)])
+        self.assertEqual([(change['field'], change['new']) for change in reloaded.price_history(2)], [('price', '190000')])
+        self.assertEqual([(change['field'], change['new']) for change in reloaded.price_history(1)], [('status', 'pending')])
+
+    def test_compaction_merges_legacy_files_and_log(self):
+        pd.DataFrame([make_listing(3, 300000), make_listing(1, 100000)]).to_csv(os.path.join(self.path, "listing_11111_9_page1_20230101.csv"), index=False)
+        pd.DataFrame([make_listing(3, 290000)]).to_csv(os.path.join(self.path, "listing_11111_9_page2_20230201.csv"), index=False)
+        store = ListingStore(self.path)
+        self.assertEqual(store.listings()[0].price, 290000)
+        store.append_batch([make_listing(1, 95000)], ['active'])
+
+        self.assertTrue(store.compact())
+        self.assertEqual(sorted(os.listdir(self.path)), ['price_history.csv', 'snapshot.csv'])
+        snapshot = pd.read_csv(os.path.join(self.path, 'snapshot.csv'))
+        self.assertEqual(list(snapshot['zpid']), [1, 3])
+        self.assertEqual(list(snapshot['price']), [95000, 290000])
+
+        reloaded = ListingStore(self.path)
+        self.assertEqual(sorted(reloaded.listings()), [make_listing(1, 95000), make_listing(3, 290000)])
+        self.assertEqual([(change['old'], change['new']) for change in reloaded.price_history(1)], [('100000', '95000')])
+        #The change between the old page files is kept too.
+        self.assertEqual([(change['at'], change['old'], change['new']) for change in reloaded.price_history(3)], [('2023-02-01', '300000', '290000')])
+        #Nothing changed, so nothing is logged.
+        self.assertEqual(reloaded.append_batch([make_listing(1, 95000)], ['active']), 0)
+
+    def test_missing_values_are_not_changes(self):
+        unknown_price = ListingData("4 Main St", "11111", None, None, None, 4, "singleFamily", "/4")
+        pd.DataFrame([unknown_price]).to_csv(os.path.join(self.path, "listing_11111_9_page1_20230101.csv"), index=False)
+        store = ListingStore(self.path)
+        self.assertEqual(store.append_batch([unknown_price], ['active']), 1)
+        store.compact()
+
+        #Read back from the snapshot the missing values are still None, so fetching it again changes nothing.
+        reloaded = ListingStore(self.path)
+        self.assertEqual(reloaded.listings(), [unknown_price])
+        self.assertEqual(reloaded.append_batch([unknown_price], ['active']), 0)
+        self.assertEqual(reloaded.price_history(4), [])
+
+if __name__ == "__main__":
+    unittest.main()
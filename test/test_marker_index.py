@@ -0,0 +1,99 @@
+import os
+import tempfile
+import time
+import unittest
+from marker_index import MarkerIndex
+
+def make_marker(address, lat, lng):
+    return {'address': address, 'geocode': {'lat': lat, 'lng': lng}, 'rating': 0, 'cashflow': 100, 'listingURL': '/url'}
+
+class TestMarkerIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = MarkerIndex()
+        self.index.insert(make_marker("inside", 40.70, -73.60))
+        self.index.insert(make_marker("edge cell", 40.79, -73.51))
+        self.index.insert(make_marker("outside", 41.50, -73.60))
+
+    def test_query_returns_only_markers_in_bounds(self):
+        found = self.index.query(40.65, -73.65, 40.75, -73.55)
+        self.assertEqual([marker['address'] for marker in found], ["inside"])
+
+    def test_reinserting_moves_marker(self):
+        self.index.insert(make_marker("outside", 40.71, -73.61))
+        found = sorted(marker['address'] for marker in self.index.query(40.65, -73.65, 40.75, -73.55))
+        self.assertEqual(found, ["inside", "outside"])
+        self.assertEqual(self.index.query(41.4, -73.7, 41.6, -73.5), [])
+        self.assertEqual(len(self.index), 3)
+
+    def test_query_across_antimeridian(self):
+        self.index.insert(make_marker("fiji", -17.7, 179.9))
+        self.index.insert(make_marker("samoa", -13.8, -172.1))
+        found = sorted(marker['address'] for marker in self.index.query(-20, 170, -10, -170))
+        self.assertEqual(found, ["fiji", "samoa"])
+
+    def test_whole_world_query_is_fast(self):
+        start = time.time()
+        found = self.index.query(-85, -180, 85, 180)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(len(found), 3)
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "index.json")
+            self.index.file_name = file_name
+            self.index.save()
+            self.assertEqual(sorted(os.listdir(directory)), ["index.json", "index.json.lock"])
+            self.assertEqual(len(MarkerIndex.load(file_name)), 3)
+
+            #Ids don't depend on insertion order, so another worker process resolves them the same,
+            #re-reading the file for markers saved after it started.
+            other_worker = MarkerIndex.load(file_name)
+            self.index.insert(make_marker("new", 40.72, -73.62))
+            self.index.save()
+            self.assertEqual(other_worker.get(self.index.id_for("new"))['address'], "new")
+            self.assertEqual(other_worker.id_for("inside"), self.index.id_for("inside"))
+
+            #A torn file starts an empty index instead of failing.
+            with open(file_name, 'w') as f:
+                f.write('[{"address": ')
+            self.assertEqual(len(MarkerIndex.load(file_name)), 0)
+
+    def test_workers_keep_each_others_markers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "index.json")
+            worker_a, worker_b = MarkerIndex.load(file_name), MarkerIndex.load(file_name)
+            worker_a.insert(make_marker("a", 40.70, -73.60))
+            worker_a.save()
+            worker_b.insert(make_marker("b", 40.71, -73.61))
+            worker_b.save()
+
+            self.assertEqual(sorted(marker['address'] for marker in MarkerIndex.load(file_name).query(40, -74, 41, -73)), ["a", "b"])
+            #Each worker answers viewports and ids with the other's markers too.
+            self.assertEqual(sorted(marker['address'] for marker in worker_a.query(40, -74, 41, -73)), ["a", "b"])
+            self.assertEqual(worker_b.get(MarkerIndex.marker_id("a"))['address'], "a")
+
+    def test_cluster_groups_by_zoom(self):
+        markers = [make_marker("a", 40.7000, -73.6000), make_marker("b", 40.7001, -73.6001), make_marker("c", 41.5, -73.6)]
+        markers[1]['rating'] = 2
+
+        singles, clusters = MarkerIndex.cluster(markers, 10)
+        self.assertEqual([marker['address'] for marker in singles], ["c"])
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(clusters[0]['count'], 2)
+        self.assertEqual(clusters[0]['rating'], 2)
+
+        #Zoomed all the way in, nothing overlaps.
+        singles, clusters = MarkerIndex.cluster(markers, 21)
+        self.assertEqual(len(singles), 3)
+        self.assertEqual(clusters, [])
+
+    def test_ids_are_stable(self):
+        marker_id = self.index.id_for("inside")
+        self.index.insert(make_marker("inside", 40.71, -73.61))
+        self.assertEqual(self.index.id_for("inside"), marker_id)
+        self.assertEqual(self.index.get(marker_id)['geocode']['lat'], 40.71)
+        self.assertIsNone(self.index.get(1000))
+
+if __name__ == "__main__":
+    unittest.main()
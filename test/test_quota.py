@@ -0,0 +1,136 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from handlers import ListingData, RentalData
+from quota import FetchPlanner, FetchPlan, QuotaExceeded, UsageCounter, ZILLOW, GEOCODE
+
+def make_listings(zip, count):
+    return [ListingData(f"{i} {zip} St", zip, 3, 2, 200000, i, "singleFamily", "/url") for i in range(count)]
+
+class TestUsageCounter(unittest.TestCase):
+
+    def test_budgets(self):
+        counter = UsageCounter(per_request=10, per_user_day=15, per_day={ZILLOW: 20})
+        small = FetchPlan([], 0, {ZILLOW: 8, GEOCODE: 0})
+
+        counter.check(small, "alice")
+        with self.assertRaises(QuotaExceeded):
+            counter.check(FetchPlan([], 0, {ZILLOW: 11}), "alice")
+
+        with counter.for_user("alice"):
+            counter.record(ZILLOW, 8)
+        #alice is now at 8 of her 15...
+        with self.assertRaises(QuotaExceeded):
+            counter.check(small, "alice")
+        counter.check(small, "bob")
+        #...and the day is at 8 of 20 zillow calls.
+        counter.record(ZILLOW, 8)
+        with self.assertRaises(QuotaExceeded):
+            counter.check(small, "bob")
+
+        snapshot = counter.snapshot()
+        self.assertEqual(snapshot['calls'], {ZILLOW: 16})
+        self.assertEqual(snapshot['userCalls'], {"alice": 8})
+
+    def test_calls_are_refused_once_a_budget_is_spent(self):
+        counter = UsageCounter(per_request=5, per_user_day=8, per_day={ZILLOW: 10})
+        with counter.for_user("alice"):
+            counter.record(ZILLOW, 5)
+            #Whatever was estimated, the request can't make a sixth call...
+            with self.assertRaises(QuotaExceeded):
+                counter.record(ZILLOW)
+        #...alice can't go over her day...
+        with counter.for_user("alice"):
+            counter.record(ZILLOW, 3)
+            with self.assertRaises(QuotaExceeded):
+                counter.record(ZILLOW)
+        #...and nobody can go over the upstream's day.
+        counter.record(ZILLOW, 2)
+        with self.assertRaises(QuotaExceeded):
+            counter.record(ZILLOW)
+        self.assertEqual(counter.snapshot()['calls'], {ZILLOW: 10})
+
+    def test_saves_are_trimmed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "usage.json")
+            with open(file_name, 'w') as f:
+                json.dump({'days': {'20000101': {ZILLOW: 3}}, 'users': {'20000101': {'alice': 3}}}, f)
+
+            counter = UsageCounter(file_name)
+            counter.record(ZILLOW)
+            counter.record(ZILLOW)
+            with open(file_name, 'r') as f:
+                saved = json.load(f)
+            #Every call is saved, old days dropped.
+            self.assertEqual(list(saved['days'].values()), [{ZILLOW: 2}])
+            self.assertNotIn('20000101', saved['users'])
+            self.assertEqual(UsageCounter(file_name).snapshot()['calls'], {ZILLOW: 2})
+            self.assertEqual(sorted(os.listdir(directory)), ["usage.json", "usage.json.lock"])
+
+            #A torn file doesn't stop the app from starting.
+            with open(file_name, 'w') as f:
+                f.write('{"days": {"2024')
+            self.assertEqual(UsageCounter(file_name).snapshot()['history'], {})
+
+    def test_budgets_hold_across_worker_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "usage.json")
+            #Two workers, each with its own counter on the shared file.
+            workers = [UsageCounter(file_name, per_user_day=6, per_day={ZILLOW: 10}) for _ in range(2)]
+            calls = 0
+            for _ in range(8):
+                for worker in workers:
+                    try:
+                        with worker.for_user("alice" if calls < 6 else "bob"):
+                            worker.record(ZILLOW)
+                        calls += 1
+                    except QuotaExceeded:
+                        pass
+            self.assertEqual(calls, 10)
+            self.assertEqual(UsageCounter(file_name).snapshot()['calls'], {ZILLOW: 10})
+            self.assertEqual(workers[0].snapshot()['userCalls'], {"alice": 6, "bob": 4})
+            with self.assertRaises(QuotaExceeded):
+                workers[1].check(FetchPlan([], 0, {ZILLOW: 1}))
+
+class TestFetchPlanner(unittest.TestCase):
+
+    def test_prefers_cached_nearby_listings_over_fetching(self):
+        #Everything cached is fully scored on file, and already geocoded.
+        on_file = MagicMock()
+        on_file.tax.return_value = 1000
+        on_file.rental.return_value = RentalData(1600, 0, 0, 0, 0, 0)
+        zip_to_listings = {"11111": make_listings("11111", 2), "22222": make_listings("22222", 4)}
+        listing_handler = MagicMock(zip_to_listings=zip_to_listings)
+        listing_handler._hometype_filtered_listings.side_effect = lambda listings: listings
+        geocoded = {listing.formattedAddress for listings in zip_to_listings.values() for listing in listings}
+
+        planner = FetchPlanner(listing_handler, {"11111": ["22222", "33333"]}, geocoded, on_file)
+
+        plan = planner.plan("11111", 5)
+        self.assertEqual(sorted(step.zip for step in plan.steps), ["11111", "22222"])
+        self.assertEqual(sum(plan.cost.values()), 0)
+        self.assertEqual(plan.listings, 6)
+
+        #Without known neighbors the rest has to be fetched.
+        planner = FetchPlanner(listing_handler, {}, geocoded, on_file)
+        plan = planner.plan("11111", 5)
+        self.assertEqual([step.zip for step in plan.steps], ["11111"])
+        self.assertEqual(plan.cost[GEOCODE], 3)
+        self.assertGreater(plan.cost[ZILLOW], 6)
+
+    def test_top_k_plan_geocodes_only_k(self):
+        on_file = MagicMock()
+        on_file.tax.return_value = None
+        on_file.rental.return_value = None
+        listing_handler = MagicMock(zip_to_listings={zip: make_listings(zip, 10) for zip in ["11111", "22222", "33333"]})
+        listing_handler._hometype_filtered_listings.side_effect = lambda listings: listings
+
+        plan = FetchPlanner(listing_handler, {}, {}, on_file).plan_top_k(["11111", "22222", "33333", "44444"], 5)
+        self.assertEqual(plan.cost[GEOCODE], 5)
+        #Only the 44444 listings need fetching, and at most 2 * 5 listings get scored.
+        self.assertEqual(plan.cost[ZILLOW], 2 + 2 * 10)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import json
+import tempfile
+import threading
+import unittest
+from safe_files import file_lock, replacing, write_json
+
+class TestSafeFiles(unittest.TestCase):
+
+    def test_replacing_only_moves_a_finished_file_in(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.json")
+            write_json(path, {"a": 1})
+            with self.assertRaises(RuntimeError):
+                with replacing(path) as tmp_path:
+                    with open(tmp_path, 'w') as f:
+                        f.write('{"a": ')
+                    raise RuntimeError("crashed while writing")
+            with open(path, 'r') as f:
+                self.assertEqual(json.load(f), {"a": 1})
+            self.assertEqual(os.listdir(directory), ["data.json"])
+
+    def test_file_lock_serializes_read_modify_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "count.json")
+            write_json(path, 0)
+
+            def increment():
+                for _ in range(50):
+                    with file_lock(path + '.lock'):
+                        with open(path, 'r') as f:
+                            count = json.load(f)
+                        write_json(path, count + 1)
+
+            threads = [threading.Thread(target=increment) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            with open(path, 'r') as f:
+                self.assertEqual(json.load(f), 200)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import datetime
+import os
+import tempfile
+import threading
+import unittest
+import pandas as pd
+from snapshot_store import CashflowSnapshotStore
+from gmaps_converter import create_app
+
+def make_frame(rows):
+    #rows of (zpid, zip, price, cashflow), the rest of the get_cashflow_list columns filled in.
+    return pd.DataFrame([{'formattedAddress': f'{zpid} Main St', 'zip': zip, 'beds': 3, 'baths': 2, 'price': price, 'zpid': zpid,
+                          'homeType': 'singleFamily', 'listingURL': f'/{zpid}', 'rent': 2000, 'expenses': 1000, 'tax': 3000,
+                          'cashflow': cashflow} for zpid, zip, price, cashflow in rows])
+
+class TestCashflowSnapshotStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = CashflowSnapshotStore(os.path.join(self.directory.name, 'snapshots'))
+        self.store.append(make_frame([(1, '01111', 100000, -50), (2, '01111', 200000, 120), (3, '02222', 150000, -10)]), datetime.date(2024, 1, 1))
+        #Scored again on the same day for a different count, which used to be a separate file.
+        self.store.append(make_frame([(1, '01111', 100000, -40)]), datetime.date(2024, 1, 1))
+        self.store.append(make_frame([(1, '01111', 90000, 30), (3, '02222', 150000, -5)]), datetime.date(2024, 2, 1))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_partitions_and_query(self):
+        self.assertEqual([(date, zip) for date, zip, _ in self.store._partitions()],
+                         [('2024-01-01', '01111'), ('2024-01-01', '02222'), ('2024-02-01', '01111'), ('2024-02-01', '02222')])
+        self.assertEqual([(date, zip) for date, zip, _ in self.store._partitions(start='2024-01-15', zips=['02222'])], [('2024-02-01', '02222')])
+
+        df = self.store.query(['cashflow'], zips=['01111'], end='20240101')
+        self.assertEqual(list(df.columns), ['zpid', 'cashflow', 'date', 'zip'])
+        self.assertEqual(df[['zpid', 'cashflow']].values.tolist(), [[1, -40], [2, 120]])
+        self.assertEqual(list(df['zip']), ['01111', '01111'])
+        self.assertTrue(self.store.query(start='2025-01-01').empty)
+
+    def test_trends(self):
+        self.assertEqual(self.store.zpid_trend(1)[['date', 'price', 'cashflow']].values.tolist(), [['2024-01-01', 100000, -40], ['2024-02-01', 90000, 30]])
+        trend = self.store.zip_trend('01111')
+        self.assertEqual(trend[['date', 'listings', 'positive']].values.tolist(), [['2024-01-01', 2, 1], ['2024-02-01', 1, 1]])
+        self.assertEqual(list(trend['medianCashflow']), [40, 30])
+
+    def test_turned_positive(self):
+        turned = self.store.turned_positive(datetime.date(2024, 1, 1))
+        self.assertEqual(turned[['zpid', 'cashflow', 'cashflowBefore', 'dateBefore']].values.tolist(), [[1, 30, -40, '2024-01-01']])
+        self.assertTrue(self.store.turned_positive('2024-02-01').empty)
+        self.assertTrue(self.store.turned_positive('2024-01-01', zips=['02222']).empty)
+
+    def test_concurrent_appends_keep_every_row(self):
+        threads = [threading.Thread(target=self.store.append, args=(make_frame([(zpid, '04444', 100000, 10)]), datetime.date(2024, 3, 1))) for zpid in range(10, 30)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(list(self.store.query(['zpid'], zips=['04444'])['zpid']), list(range(10, 30)))
+
+    def test_partitions_with_differently_typed_columns_scan_together(self):
+        int_tax = make_frame([(5, '05555', 100000, 10)])
+        float_tax = make_frame([(6, '05555', 100000, 20)]).assign(tax=3000.5, beds=None)
+        self.store.append(int_tax, datetime.date(2024, 4, 1))
+        self.store.append(float_tax, datetime.date(2024, 4, 2))
+        self.assertIn('part.parquet', os.listdir(self.store._partition_dir('2024-04-02', '05555')))
+
+        df = self.store.query(['tax', 'beds'], zips=['05555'])
+        self.assertEqual(df['tax'].tolist(), [3000, 3000.5])
+        self.assertEqual(df['beds'].isna().tolist(), [False, True])
+        self.assertEqual(self.store.query(['zpid'], zpids=[6])['zpid'].tolist(), [6])
+
+    def test_partitions_from_older_versions_are_read(self):
+        #A csv partition, and a parquet one written with whatever types pandas picked.
+        csv_dir, parquet_dir = self.store._partition_dir('2023-12-01', '01111'), self.store._partition_dir('2023-12-02', '01111')
+        os.makedirs(csv_dir)
+        os.makedirs(parquet_dir)
+        make_frame([(1, '01111', 110000, -70)]).drop(columns=['zip']).to_csv(os.path.join(csv_dir, 'part.csv'), index=False)
+        make_frame([(1, '01111', 110000, -60)]).drop(columns=['zip']).assign(beds=None).to_parquet(os.path.join(parquet_dir, 'part.parquet'), index=False)
+        self.assertEqual(self.store.zpid_trend(1, end='2023-12-31')['cashflow'].tolist(), [-70, -60])
+
+        #Appending to the csv partition rewrites it as parquet.
+        self.store.append(make_frame([(2, '01111', 200000, 50)]), datetime.date(2023, 12, 1))
+        self.assertNotIn('part.csv', os.listdir(csv_dir))
+        self.assertEqual(self.store.query(['cashflow'], end='2023-12-01')['cashflow'].tolist(), [-70, 50])
+
+    def test_import_legacy_files(self):
+        legacy_directory = os.path.join(self.directory.name, 'cashflow_data')
+        os.makedirs(legacy_directory)
+        make_frame([(4, '03333', 100000, 10)]).to_csv(os.path.join(legacy_directory, '03333_count5_20230301.csv'), index=False)
+        make_frame([(4, '03333', 100000, 15)]).to_csv(os.path.join(legacy_directory, '03333_count9_20230301.csv'), index=False)
+
+        self.assertEqual(self.store.import_legacy_files(legacy_directory), 2)
+        self.assertEqual(self.store.zpid_trend(4)[['date', 'cashflow']].values.tolist(), [['2023-03-01', 15]])
+
+class TestHistoryRoutes(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        app = create_app({'API_KEYS': {'GMAPS_KEY': 'test', 'ZILLOW_KEY': 'test', 'ZIPCODE_KEY': 'test'}, 'MARKER_INDEX_FILE': 'no_such_index.json',
+                          'USAGE_FILE': None, 'LISTING_COMPACTION_SECONDS': None, 'SNAPSHOT_DIR': self.directory.name})
+        app.extensions['snapshot_store'].append(make_frame([(1, '01111', 100000, -50.5)]), datetime.date(2024, 1, 1))
+        app.extensions['snapshot_store'].append(make_frame([(1, '01111', 100000, 20.25)]), datetime.date(2024, 1, 2))
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_history_routes(self):
+        self.assertEqual([row['cashflow'] for row in self.client.get('/history/zpid/1?start=2024-01-02').get_json()], [20.25])
+        self.assertEqual([row['listings'] for row in self.client.get('/history/zip/01111').get_json()], [1, 1])
+        self.assertEqual([row['zpid'] for row in self.client.get('/history/turned-positive?since=2024-01-01&zip=01111').get_json()], [1])
+        self.assertEqual(self.client.get('/history/turned-positive').status_code, 400)
+        self.assertEqual(self.client.get('/history/zpid/1?start=yesterday').status_code, 400)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from upstream import UpstreamController, UpstreamUnavailable
+
+def make_response(status_code, headers = None):
+    return MagicMock(status_code=status_code, headers=headers or {})
+
+@patch("upstream.time.sleep")
+@patch("requests.get")
+class TestUpstreamController(unittest.TestCase):
+
+    def test_fast_successes_raise_limit(self, mock_get, mock_sleep):
+        mock_get.return_value = make_response(200)
+        controller = UpstreamController("host", initial_limit=2, max_limit=4)
+        for _ in range(20):
+            controller.get("url")
+        self.assertEqual(controller.limit, 4)
+
+    def test_client_errors_are_not_retried(self, mock_get, mock_sleep):
+        mock_get.return_value = make_response(404)
+        controller = UpstreamController("host")
+        self.assertEqual(controller.get("url").status_code, 404)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(controller.circuit, UpstreamController.CLOSED)
+
+    def test_429_honors_retry_after_and_halves_limit(self, mock_get, mock_sleep):
+        mock_get.side_effect = [make_response(429, {'Retry-After': '0'}), make_response(200)]
+        controller = UpstreamController("host", initial_limit=4)
+        attempts = MagicMock()
+        self.assertEqual(controller.get("url", on_attempt=attempts).status_code, 200)
+        self.assertEqual(attempts.call_count, 2)
+        self.assertLess(controller.limit, 4)
+
+        #A Retry-After longer than we are willing to wait sheds the call instead of sleeping.
+        mock_get.side_effect = [make_response(429, {'Retry-After': '120'})]
+        with self.assertRaises(UpstreamUnavailable):
+            controller.get("url")
+        with self.assertRaises(UpstreamUnavailable):
+            controller.get("url")
+        self.assertEqual(mock_get.call_count, 3)
+
+    def test_circuit_opens_on_5xx_and_fails_fast(self, mock_get, mock_sleep):
+        mock_get.return_value = make_response(503)
+        controller = UpstreamController("host", failure_threshold=3, max_retries=5)
+        self.assertEqual(controller.get("url").status_code, 503)
+        self.assertEqual(mock_get.call_count, 3)
+        self.assertEqual(controller.circuit, UpstreamController.OPEN)
+
+        with self.assertRaises(UpstreamUnavailable):
+            controller.get("url")
+        self.assertEqual(mock_get.call_count, 3)
+
+        #Once the open period is over a probe closes it again.
+        controller.open_until = 0
+        mock_get.return_value = make_response(200)
+        self.assertEqual(controller.get("url").status_code, 200)
+        self.assertEqual(controller.circuit, UpstreamController.CLOSED)
+
+    def test_on_attempt_can_refuse_the_call(self, mock_get, mock_sleep):
+        controller = UpstreamController("host")
+        with self.assertRaises(RuntimeError):
+            controller.get("url", on_attempt=MagicMock(side_effect=RuntimeError("over quota")))
+        mock_get.assert_not_called()
+        self.assertEqual(controller.in_flight, 0)
+
+    def test_timeouts_are_failures(self, mock_get, mock_sleep):
+        import requests
+        mock_get.side_effect = requests.Timeout("read timed out")
+        controller = UpstreamController("host", latency_target=2, failure_threshold=2, max_retries=1)
+        with self.assertRaises(UpstreamUnavailable):
+            controller.get("url")
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(mock_get.call_args.kwargs['timeout'], (2, 10))
+        self.assertEqual(controller.circuit, UpstreamController.OPEN)
+        self.assertEqual(controller.in_flight, 0)
+
+if __name__ == "__main__":
+    unittest.main()
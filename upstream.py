@@ -0,0 +1,212 @@
+import time
+import threading
+import logging
+import datetime
+from email.utils import parsedate_to_datetime
+
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling an upstream that is unhealthy, throttling us, or already at its concurrency limit."""
+    pass
+
+
+class UpstreamController:
+    """
+    Guards every call to one upstream host:
+    -AIMD concurrency limit: +1 per limit's worth of fast successes, halved on a 429 or a slow response.
+    -Retry-After is honored for every caller, not just the one that got the 429.
+    -Circuit breaker: after "failure_threshold" straight failures calls fail fast for "open_seconds",
+     then a single probe call decides whether to close it again.
+    Callers that would have to wait longer than "max_wait" are shed with UpstreamUnavailable instead of sleeping.
+    Every call gets a connect/read timeout derived from "latency_target", so a hung upstream frees its slot and counts as a failure.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, host, initial_limit = 2, min_limit = 1, max_limit = 8, latency_target = 3.0,
+                 failure_threshold = 5, open_seconds = 30, max_wait = 10, max_retries = 3):
+        self.host = host
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target #seconds, slower successes count as congestion
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        #(connect, read) seconds: a call this slow is far past congested, treat it as down.
+        self.timeout = (latency_target, latency_target * 5)
+
+        self.in_flight = 0
+        self.blocked_until = 0 #set from Retry-After
+        self.circuit = self.CLOSED
+        self.open_until = 0
+        self.consecutive_failures = 0
+        self.latency_ewma = None
+        self.counts = {'success': 0, 'throttled': 0, 'failure': 0, 'shed': 0}
+        self.condition = threading.Condition()
+
+    def _acquire(self):
+        """
+        Waits for a free concurrency slot, or raises UpstreamUnavailable if the circuit is open or the wait would be too long.
+        """
+        deadline = time.time() + self.max_wait
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.circuit == self.OPEN:
+                    if now < self.open_until:
+                        self.counts['shed'] += 1
+                        raise UpstreamUnavailable(f"{self.host} circuit is open for another {self.open_until - now:.0f}s")
+                    #Let a single probe through to test the upstream.
+                    self._set_circuit(self.HALF_OPEN)
+                    self.limit = self.min_limit
+                if self.blocked_until > deadline:
+                    self.counts['shed'] += 1
+                    raise UpstreamUnavailable(f"{self.host} asked us to back off for another {self.blocked_until - now:.0f}s")
+
+                if now >= self.blocked_until and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                if now >= deadline:
+                    self.counts['shed'] += 1
+                    raise UpstreamUnavailable(f"{self.host} is at its concurrency limit of {int(self.limit)}")
+                self.condition.wait(min(deadline, max(self.blocked_until, now + 0.05)) - now)
+
+    def _release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def _set_circuit(self, circuit):
+        if circuit != self.circuit:
+            logging.warning(f"upstream {self.host} circuit {self.circuit} -> {circuit}")
+            self.circuit = circuit
+
+    def on_success(self, latency):
+        with self.condition:
+            self.counts['success'] += 1
+            self.consecutive_failures = 0
+            self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+            if latency > self.latency_target:
+                self.limit = max(self.min_limit, self.limit / 2)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._set_circuit(self.CLOSED)
+            self.condition.notify_all()
+
+    def on_throttled(self, retry_after):
+        with self.condition:
+            self.counts['throttled'] += 1
+            self.limit = max(self.min_limit, self.limit / 2)
+            self.blocked_until = max(self.blocked_until, time.time() + retry_after)
+
+    def on_failure(self):
+        with self.condition:
+            self.counts['failure'] += 1
+            self.consecutive_failures += 1
+            self.limit = max(self.min_limit, self.limit / 2)
+            if self.circuit == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self._set_circuit(self.OPEN)
+                self.open_until = time.time() + self.open_seconds
+
+    @staticmethod
+    def _parse_retry_after(value, default):
+        """
+        Retry-After is either a number of seconds or an HTTP date.
+        """
+        if value is None:
+            return default
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return default
+
+    def get(self, url, on_attempt = None, **kwargs):
+        """
+        requests.get("url", **kwargs) through this controller, retrying 429s, 5xxs and connection errors.
+        Any other response, successful or not, is returned for the caller to handle.
+        "on_attempt" is called right before every request is sent, e.g. to count it against a quota.
+        Whatever it raises refuses the call and is passed on to the caller.
+        """
+        import requests
+
+        kwargs.setdefault('timeout', self.timeout)
+        for retry_count in range(self.max_retries + 1):
+            self._acquire()
+            start = time.time()
+            try:
+                if on_attempt is not None:
+                    on_attempt()
+                response = requests.get(url, **kwargs)
+            except requests.RequestException as e:
+                #Timeouts included, a hung upstream is a failed one.
+                logging.debug(f"{self.host} request failed: {e}")
+                self.on_failure()
+                response = None
+            else:
+                if response.status_code == 429:
+                    self.on_throttled(self._parse_retry_after(response.headers.get('Retry-After'), 2 ** retry_count))
+                elif response.status_code >= 500:
+                    self.on_failure()
+                else:
+                    #4xx other than 429 is the request's fault, not the upstream's.
+                    self.on_success(time.time() - start)
+                    return response
+            finally:
+                self._release()
+
+            #Back off before retrying 5xx/connection errors; 429 waits are enforced by _acquire from Retry-After.
+            if retry_count < self.max_retries and (response is None or response.status_code >= 500):
+                backoff = 2 ** retry_count
+                if backoff > self.max_wait or self.circuit == self.OPEN:
+                    break
+                time.sleep(backoff)
+
+        if response is None:
+            raise UpstreamUnavailable(f"{self.host} could not be reached after {retry_count + 1} attempts")
+        return response
+
+    def state(self):
+        """
+        Returns this controller's current state, for instrumentation.
+        """
+        with self.condition:
+            now = time.time()
+            return {
+                'host': self.host,
+                'circuit': self.circuit,
+                'openFor': max(0, self.open_until - now) if self.circuit == self.OPEN else 0,
+                'limit': round(self.limit, 2),
+                'inFlight': self.in_flight,
+                'blockedFor': max(0, self.blocked_until - now),
+                'latencyEwma': self.latency_ewma,
+                'consecutiveFailures': self.consecutive_failures,
+                'counts': dict(self.counts),
+            }
+
+
+_host_to_controller = {}
+_controllers_lock = threading.Lock()
+
+def get_controller(host):
+    """
+    Returns the shared UpstreamController for "host", creating it on first use.
+    """
+    with _controllers_lock:
+        if host not in _host_to_controller:
+            _host_to_controller[host] = UpstreamController(host)
+        return _host_to_controller[host]
+
+def controller_states():
+    """
+    Returns the state of every upstream controller created so far.
+    """
+    with _controllers_lock:
+        controllers = list(_host_to_controller.values())
+    return [controller.state() for controller in controllers]